@@ -0,0 +1,9 @@
+"""Benchmarks for the blockchain node.
+
+Run from the src directory, for example:
+    python3 -m benchmarks.micro --numtxinblock 50000 --output micro.json
+    python3 -m benchmarks.network --nodes 3 --rate 20000 --output net.json
+    python3 -m benchmarks.sync --blocks 2000 --sources 2 --output sync.json
+    python3 -m benchmarks.simulate --nodes 50 --rate 200 --output sim.json
+    python3 -m benchmarks.mining --numcores 4
+"""
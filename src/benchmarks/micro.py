@@ -0,0 +1,112 @@
+"""Microbenchmarks for the hot paths of a node.
+
+Tasks:
+    Time transaction, block and header parsing at full block size
+    Time block hashing and mining hash rate
+    Time transaction processing against the ledger, sharded or not
+    Write the results as JSON
+
+Run from the src directory:
+    python3 -m benchmarks.micro --numtxinblock 50000 --output micro.json
+"""
+
+import os
+import argparse
+import tempfile
+import contextlib
+
+from block import Block
+from codec import HEADER_SIZE, encode_header, iter_transactions
+from miner import MiningEngine
+from transaction import Transaction
+from utxo import UTXO
+from benchmarks.workload import (UNREACHABLE_DIFFICULTY, make_transactions,
+                                 rate, write_results)
+
+
+def bench_parse(transactions, block_message, repeat):
+    """Transactions, blocks and block headers parsed per second."""
+    def parse_transactions():
+        for tx_bytes in transactions:
+            Transaction(tx_bytes)
+
+    def parse_block():
+        block = Block(0, block_message, 0)
+        for _ in iter_transactions(block.block_data):
+            pass
+
+    return ({"parse_transaction_tx_per_s": rate(parse_transactions,
+                                                len(transactions), repeat),
+             "parse_block_blocks_per_s": rate(parse_block, 1, repeat),
+             "parse_block_tx_per_s": rate(parse_block, len(transactions),
+                                          repeat),
+             "parse_header_blocks_per_s": rate(
+                 lambda: Block(0, block_message[0:HEADER_SIZE], 0), 1,
+                 10000)})
+
+
+def bench_hash(block_message, hashes):
+    """Full block hashes and midstate mining hashes per second."""
+    block = Block(0, block_message, 0)
+    engine = MiningEngine(block.hash_prefix(), UNREACHABLE_DIFFICULTY)
+    return ({"compute_block_hash_per_s": rate(block.compute_block_hash, 1,
+                                              max(1, hashes // 1000)),
+             "mining_hashes_per_s": rate(lambda: engine.search(0, hashes),
+                                         hashes)})
+
+
+def bench_process(transactions, shards):
+    """Transactions per second through process_transaction and batches."""
+    numtxinblock = len(transactions) + 1  # Keep mining out of the timing
+    with tempfile.TemporaryDirectory() as datadir:
+        utxo = UTXO(numtxinblock, 0, 0, datadir=datadir)
+        parsed = [Transaction(tx_bytes) for tx_bytes in transactions]
+
+        def process_transactions():
+            for transaction in parsed:
+                utxo.process_transaction(transaction)
+
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                single = rate(process_transactions, len(parsed))
+        batch_utxo = UTXO(numtxinblock, 0, 0,
+                          datadir=os.path.join(datadir, "batch"))
+        batch_data = memoryview(b''.join(transactions))
+        batch = rate(lambda: batch_utxo.process_batch(batch_data),
+                     len(transactions))
+        sharded_utxo = UTXO(numtxinblock, 0, 0,
+                            datadir=os.path.join(datadir, "sharded"),
+                            num_shards=shards)
+        sharded = rate(lambda: sharded_utxo.process_batch(batch_data),
+                       len(transactions))
+        sharded_utxo.utxo.close()
+    return ({"process_transaction_tx_per_s": single,
+             "process_batch_tx_per_s": batch,
+             "process_batch_sharded_tx_per_s": sharded})
+
+
+def main():
+    """Run microbenchmarks."""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--numtxinblock', type=int, default=50000)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--hashes', type=int, default=200000)
+    arg_parser.add_argument('--shards', type=int, default=4,
+                            help="Ledger shards for the sharded batch run")
+    arg_parser.add_argument('--output', default=None,
+                            help="File to write JSON results to")
+    arg_list = arg_parser.parse_args()
+
+    transactions = make_transactions(arg_list.numtxinblock)
+    header = encode_header(0, bytes(32), bytes(32), 0, 0, bytes(32))
+    block_message = header + b''.join(transactions)
+
+    results = {}
+    results.update(bench_parse(transactions, block_message, arg_list.repeat))
+    results.update(bench_hash(block_message, arg_list.hashes))
+    results.update(bench_process(transactions, arg_list.shards))
+    write_results(arg_list.output, "micro", vars(arg_list), results)
+
+
+if __name__ == "__main__":
+    main()
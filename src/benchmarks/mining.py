@@ -0,0 +1,59 @@
+"""Measure how mining throughput scales with the number of cores.
+
+Tasks:
+    Mine an unreachable target for a fixed time on 1..N cores
+    Report hashes per second and speedup over a single core
+"""
+
+import os
+import argparse
+import threading
+
+from codec import HEADER_SIZE
+from miner import MiningEngine, MiningPool
+from benchmarks.workload import UNREACHABLE_DIFFICULTY
+
+
+def block_prefix():
+    """Build the fixed header part that is hashed ahead of the nonce."""
+    return (os.urandom(HEADER_SIZE - 64))
+
+
+def single_core_hashrate(prefix, seconds):
+    """Hash rate of the engine in the current process."""
+    engine = MiningEngine(prefix, UNREACHABLE_DIFFICULTY)
+    stop_event = threading.Event()
+    timer = threading.Timer(seconds, stop_event.set)
+    timer.start()
+    engine.run(0, stop_event)
+    return (engine.hashrate())
+
+
+def pool_hashrate(mining_pool, prefix, seconds):
+    """Hash rate of the mining pool over a fixed duration."""
+    timer = threading.Timer(seconds, mining_pool.cancel)
+    timer.start()
+    mining_pool.mine(prefix, UNREACHABLE_DIFFICULTY, 0)
+    return (mining_pool.hashrate())
+
+
+def main():
+    """Run mining benchmark."""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--numcores', type=int, default=os.cpu_count())
+    arg_parser.add_argument('--seconds', type=float, default=3.0)
+    arg_list = arg_parser.parse_args()
+
+    prefix = block_prefix()
+    baseline = single_core_hashrate(prefix, arg_list.seconds)
+    print ("engine: {:.0f} H/s".format(baseline))
+    for numcores in range(1, arg_list.numcores + 1):
+        mining_pool = MiningPool(numcores)
+        hashrate = pool_hashrate(mining_pool, prefix, arg_list.seconds)
+        mining_pool.close()
+        print ("cores: {} -- {:.0f} H/s -- speedup: {:.2f}x".format(
+            numcores, hashrate, hashrate / baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""End-to-end benchmark of several local nodes under client load.
+
+Tasks:
+    Start N nodes through main.py with every other node as a peer
+    Drive them with transaction batches at a configurable rate
+    Report tx/s, accept latency, block propagation time and RSS as JSON
+
+Run from the src directory:
+    python3 -m benchmarks.network --nodes 3 --rate 20000 --output net.json
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from codec import LENGTH_STRUCT, encode_batch, encode_frame
+from server import CLOSE_OPCODE, GET_BLOCK_OPCODE, TX_BATCH_OPCODE
+from benchmarks.workload import make_transactions, write_results
+
+POLL_INTERVAL = 0.01  # Seconds between block height polls
+
+
+def receive_exactly(node_socket, size):
+    """Receive exactly size bytes."""
+    data = bytearray()
+    while (len(data) < size):
+        chunk = node_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Node closed connection")
+        data.extend(chunk)
+    return (bytes(data))
+
+
+def connect(port, timeout=10.0):
+    """Connect to a node, waiting for it to start listening."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return (socket.create_connection(('localhost', port)))
+        except OSError:
+            if (time.time() > deadline):
+                raise
+            time.sleep(0.05)
+
+
+def start_nodes(arg_list, workdir):
+    """Launch the nodes and return their processes."""
+    ports = [arg_list.base_port + i for i in range(arg_list.nodes)]
+    processes = []
+    for port in ports:
+        peers = ",".join(str(peer) for peer in ports if peer != port)
+        command = [sys.executable, "main.py", "--port", str(port),
+                   "--peers", peers, "--mode", "asyncio",
+                   "--numtxinblock", str(arg_list.numtxinblock),
+                   "--maxblockwait", str(arg_list.maxblockwait),
+                   "--difficulty", str(arg_list.difficulty),
+                   "--numcores", str(arg_list.numcores),
+                   "--datadir", os.path.join(workdir, str(port))]
+        log_file = open(os.path.join(workdir, "{}.log".format(port)), "w")
+        processes.append(subprocess.Popen(command, stdout=log_file,
+                                          stderr=subprocess.STDOUT))
+    return (ports, processes)
+
+
+def percentile(values, fraction):
+    """Value below which fraction of sorted values fall."""
+    if not values:
+        return (None)
+    values = sorted(values)
+    return (values[min(len(values) - 1, int(fraction * len(values)))])
+
+
+def rss_bytes(pid):
+    """Resident set size of a process."""
+    with open("/proc/{}/status".format(pid)) as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return (int(line.split()[1]) * 1024)
+    return (None)
+
+
+class BlockWatcher(object):
+    """Poll every node for new blocks and note when each height appears."""
+
+    def __init__(self, ports):
+        """Start polling thread for the given node ports."""
+        self.ports = ports
+        self.first_seen = {}  # (port, height) to time first seen
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def has_block(self, node_socket, height):
+        """Ask a node for the block at height."""
+        node_socket.sendall(encode_frame(GET_BLOCK_OPCODE,
+                                         height.to_bytes(32, 'big')))
+        length = LENGTH_STRUCT.unpack(receive_exactly(node_socket,
+                                                      LENGTH_STRUCT.size))[0]
+        receive_exactly(node_socket, length)
+        return (length > 0)
+
+    def run(self):
+        """Poll until stopped."""
+        sockets = {port: connect(port) for port in self.ports}
+        heights = {port: 0 for port in self.ports}
+        while not self.stopping:
+            for port, node_socket in sockets.items():
+                while self.has_block(node_socket, heights[port]):
+                    self.first_seen[(port, heights[port])] = time.time()
+                    heights[port] += 1
+            time.sleep(POLL_INTERVAL)
+        for node_socket in sockets.values():
+            node_socket.close()
+
+    def stop(self):
+        """Stop polling and return block propagation times in seconds."""
+        self.stopping = True
+        self.thread.join()
+        propagation = []
+        height = 0
+        while all((port, height) in self.first_seen for port in self.ports):
+            seen = [self.first_seen[(port, height)] for port in self.ports]
+            propagation.append(max(seen) - min(seen))
+            height += 1
+        return (propagation)
+
+
+def drive_load(ports, arg_list):
+    """Send batches round robin at the target rate, return latencies."""
+    sockets = [connect(port) for port in ports]
+    interval = arg_list.batch / float(arg_list.rate)
+    latencies = []
+    accepted = 0
+    sent = 0
+    start_time = time.time()
+    next_send = start_time
+    while (time.time() - start_time < arg_list.duration):
+        node_socket = sockets[(sent // arg_list.batch) % len(sockets)]
+        transactions = make_transactions(arg_list.batch, sent)
+        send_time = time.time()
+        node_socket.sendall(encode_frame(TX_BATCH_OPCODE,
+                                         encode_batch(transactions)))
+        bitmap = receive_exactly(node_socket, (arg_list.batch + 7) // 8)
+        latencies.append(time.time() - send_time)
+        accepted += sum(bin(byte).count("1") for byte in bitmap)
+        sent += arg_list.batch
+        next_send += interval
+        time.sleep(max(0.0, next_send - time.time()))
+    elapsed = time.time() - start_time
+    for node_socket in sockets:
+        node_socket.close()
+    return (sent, accepted, elapsed, latencies)
+
+
+def stop_nodes(ports, processes):
+    """Ask each node to close and wait for it to exit."""
+    for port in ports:
+        try:
+            close_socket = connect(port, timeout=1.0)
+            close_socket.sendall(encode_frame(CLOSE_OPCODE))
+            close_socket.close()
+        except OSError:
+            pass  # Node has already closed
+    for process in processes:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    """Run the network benchmark."""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--nodes', type=int, default=3)
+    arg_parser.add_argument('--base-port', type=int, default=9500)
+    arg_parser.add_argument('--numtxinblock', type=int, default=5000)
+    arg_parser.add_argument('--maxblockwait', type=float, default=1.0,
+                            help="Seconds before nodes seal a partial block")
+    arg_parser.add_argument('--difficulty', type=int, default=2)
+    arg_parser.add_argument('--numcores', type=int, default=0)
+    arg_parser.add_argument('--rate', type=int, default=10000,
+                            help="Target transactions per second")
+    arg_parser.add_argument('--batch', type=int, default=100,
+                            help="Transactions per TX_BATCH message")
+    arg_parser.add_argument('--duration', type=float, default=10.0)
+    arg_parser.add_argument('--settle', type=float, default=2.0,
+                            help="Seconds to wait for blocks after load")
+    arg_parser.add_argument('--output', default=None,
+                            help="File to write JSON results to")
+    arg_list = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        ports, processes = start_nodes(arg_list, workdir)
+        try:
+            watcher = BlockWatcher(ports)
+            sent, accepted, elapsed, latencies = drive_load(ports, arg_list)
+            time.sleep(arg_list.settle)
+            propagation = watcher.stop()
+            rss = [rss_bytes(process.pid) for process in processes]
+        finally:
+            stop_nodes(ports, processes)
+
+    results = {"sent": sent,
+               "accepted": accepted,
+               "tx_per_s": accepted / elapsed,
+               "accept_latency_p50_s": percentile(latencies, 0.50),
+               "accept_latency_p99_s": percentile(latencies, 0.99),
+               "blocks": len(propagation),
+               "block_propagation_p50_s": percentile(propagation, 0.50),
+               "block_propagation_max_s": max(propagation, default=None),
+               "rss_bytes": rss}
+    write_results(arg_list.output, "network", vars(arg_list), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""Simulate a network of nodes in one process over in-memory links.
+
+Every node is a full Server without a socket, driven by calling
+process_message. Links deliver frames after a serialization delay set by
+their bandwidth plus a latency, in order like a TCP connection. A lost
+frame is resent after a retransmission timeout, so loss shows up as
+delay. Time is simulated and every random choice comes from one seeded
+generator, so a run is reproducible and much faster than real time.
+
+Mining is modelled rather than done: a node that seals a block finds it
+after an exponential delay, so the whole network finds one block every
+--blocktime seconds on average. Message handling costs no simulated
+time. Nodes keep the first block they see at each height and do not
+reorganize, so after a fork each side keeps its own chain.
+
+Tasks:
+    Build a random topology of simulated nodes and links
+    Feed it a synthetic transaction workload, or replay a recorded one
+    Record workloads so the same traffic can be replayed against changes
+    Report block propagation times, orphan rate and throughput as JSON
+
+Run from the src directory:
+    python3 -m benchmarks.simulate --nodes 50 --rate 200 --output sim.json
+"""
+
+import os
+import time
+import heapq
+import random
+import argparse
+import tempfile
+import contextlib
+from struct import Struct
+from itertools import count
+from collections import Counter
+
+from codec import (FRAME_STRUCT, HEADER_SIZE, TX_SIZE, decode_frame_header,
+                   encode_batch, encode_frame)
+from miner import MiningEngine
+from server import TX_BATCH_OPCODE, Server
+from benchmarks.network import percentile
+from benchmarks.workload import make_transactions, write_results
+
+RECORD_STRUCT = Struct('>dI')  # Send time and node of a recorded frame
+MIN_RTO = 0.2  # Shortest retransmission timeout in seconds
+
+
+def decode_frame(frame):
+    """Return (opcode, message) of one encoded frame."""
+    opcode, length = decode_frame_header(frame[1:FRAME_STRUCT.size])
+    return (opcode, bytes(frame[FRAME_STRUCT.size:FRAME_STRUCT.size
+                                + length]))
+
+
+def synthetic_workload(arg_list, rng):
+    """Transaction batches as (time, node, frame), spread over the run."""
+    interval = arg_list.batch / arg_list.rate
+    workload = []
+    for i in range(int(arg_list.duration / interval)):
+        transactions = make_transactions(arg_list.batch, i * arg_list.batch)
+        workload.append((i * interval, rng.randrange(arg_list.nodes),
+                         encode_frame(TX_BATCH_OPCODE,
+                                      encode_batch(transactions))))
+    return (workload)
+
+
+def write_workload(path, workload):
+    """Save a workload so it can be replayed."""
+    with open(path, "wb") as workload_file:
+        for send_time, node, frame in workload:
+            workload_file.write(RECORD_STRUCT.pack(send_time, node))
+            workload_file.write(frame)
+
+
+def read_workload(path):
+    """Load a workload saved by write_workload."""
+    workload = []
+    with open(path, "rb") as workload_file:
+        while True:
+            record = workload_file.read(RECORD_STRUCT.size)
+            if not record:
+                break
+            send_time, node = RECORD_STRUCT.unpack(record)
+            frame_header = workload_file.read(FRAME_STRUCT.size)
+            _, length = decode_frame_header(frame_header[1:])
+            workload.append((send_time, node,
+                             frame_header + workload_file.read(length)))
+    return (workload)
+
+
+class Link(object):
+    """One direction of a connection between two simulated nodes."""
+
+    def __init__(self, latency, bandwidth, loss):
+        """Initialize link, bandwidth in bytes per second."""
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.free_at = 0.0  # When the last frame finishes sending
+        self.last_arrival = 0.0  # Frames arrive in the order they are sent
+
+    def arrival(self, now, size, rng):
+        """Time a frame of size bytes sent at now reaches the other end."""
+        self.free_at = max(now, self.free_at) + size / self.bandwidth
+        arrival = self.free_at + self.latency
+        while (rng.random() < self.loss):  # Resent until it gets through
+            arrival += max(MIN_RTO, 2 * self.latency)
+        self.last_arrival = max(arrival, self.last_arrival)
+        return (self.last_arrival)
+
+
+class SimPeers(object):
+    """Stands in for a node's PeerManager, sending over simulated links."""
+
+    def __init__(self, network, node):
+        """Initialize peers of node in network."""
+        self.network = network
+        self.node = node
+        self.connections = []  # No sockets to report statistics for
+
+    def broadcast(self, message):
+        """Send a frame to every neighbour."""
+        for peer in self.network.neighbours[self.node]:
+            self.network.send(self.node, peer, message)
+
+    def close(self):
+        """Nothing to flush."""
+
+
+class SimMiner(object):
+    """Stands in for BackgroundMiner, finding blocks after a random delay."""
+
+    def __init__(self, network, node):
+        """Initialize miner of node in network."""
+        self.network = network
+        self.node = node
+        self.job = 0  # Bumped to abandon the block being mined
+
+    def start(self, block):
+        """Schedule when block is found."""
+        self.job += 1
+        network = self.network
+        delay = network.rng.expovariate(1.0 / network.mean_mining_time)
+        network.schedule(network.now + delay, self.found, self.job, block)
+
+    def found(self, job, block):
+        """Solve block and hand it to the node, unless it was cancelled."""
+        if (job != self.job):
+            return
+        engine = MiningEngine(block.hash_prefix(), block.difficulty)
+        block.set_solution(*engine.run(self.network.rng.randrange(1 << 64)))
+        self.network.nodes[self.node].on_block_mined(block)
+        self.network.after_event(self.node)
+
+    def cancel(self):
+        """Abandon the block being mined."""
+        self.job += 1
+
+
+class Network(object):
+    """Simulated nodes, the links between them and an event queue."""
+
+    def __init__(self, arg_list, workdir):
+        """Build nodes and a random topology from the arguments."""
+        self.rng = random.Random(arg_list.seed)
+        self.now = 0.0
+        self.events = []  # Heap of (time, sequence, callback, args)
+        self.sequence = count()  # Orders events scheduled for one time
+        self.mean_mining_time = arg_list.blocktime * arg_list.nodes
+        self.nodes = [self.create_node(i, arg_list, workdir)
+                      for i in range(arg_list.nodes)]
+        self.neighbours = self.create_topology(arg_list.nodes,
+                                               arg_list.degree)
+        self.links = {}
+        for node, peers in enumerate(self.neighbours):
+            for peer in peers:
+                latency = arg_list.latency / 1000 * self.rng.uniform(0.5, 1.5)
+                self.links[(node, peer)] = Link(latency,
+                                                arg_list.bandwidth * 1e6 / 8,
+                                                arg_list.loss)
+        self.heights = [0] * len(self.nodes)  # Blocks seen by each node
+        self.seal_at = [None] * len(self.nodes)  # Scheduled seal checks
+        self.block_times = {}  # Block hash to times nodes stored it
+        self.block_sizes = {}  # Block hash to transaction count
+        self.messages = Counter()  # Frames sent per opcode
+        self.message_bytes = Counter()
+        self.client_replies = 0
+
+    def create_node(self, index, arg_list, workdir):
+        """Server for one node, wired to the simulated network."""
+        node = Server(["--port", str(index), "--peers", "",
+                       "--numtxinblock", str(arg_list.numtxinblock),
+                       "--maxblockwait", str(arg_list.maxblockwait),
+                       "--difficulty", str(arg_list.difficulty),
+                       "--datadir", os.path.join(workdir, str(index))],
+                      listen=False, peer_manager=SimPeers(self, index))
+        node.utxo.mempool.clock = self.clock
+        node.utxo.background_miner = SimMiner(self, index)
+        return (node)
+
+    def create_topology(self, num_nodes, degree):
+        """Neighbours of each node: a ring plus random chords."""
+        neighbours = [set() for _ in range(num_nodes)]
+        for node in range(num_nodes):
+            peer = (node + 1) % num_nodes
+            if (peer != node):
+                neighbours[node].add(peer)
+                neighbours[peer].add(node)
+        degree = min(degree, num_nodes - 1)
+        for node in range(num_nodes):
+            candidates = [peer for peer in range(num_nodes)
+                          if peer != node and peer not in neighbours[node]
+                          and len(neighbours[peer]) < degree]
+            self.rng.shuffle(candidates)
+            for peer in candidates[0:degree - len(neighbours[node])]:
+                neighbours[node].add(peer)
+                neighbours[peer].add(node)
+        return ([sorted(peers) for peers in neighbours])
+
+    def clock(self):
+        """Simulated time, used as every mempool clock."""
+        return (self.now)
+
+    def schedule(self, at, callback, *args):
+        """Run callback(*args) at simulated time at."""
+        heapq.heappush(self.events, (at, next(self.sequence), callback, args))
+
+    def send(self, source, target, frame, request=False):
+        """Send a frame over the link from source to target.
+
+        A request is a peer asking the node it received a message from for
+        more, over that node's own connection to it.
+        """
+        opcode, _ = decode_frame_header(frame[1:FRAME_STRUCT.size])
+        self.messages[opcode] += 1
+        self.message_bytes[opcode] += len(frame)
+        arrival = self.links[(source, target)].arrival(self.now, len(frame),
+                                                       self.rng)
+        self.schedule(arrival, self.deliver, source, target, frame, request)
+
+    def deliver(self, source, target, frame, request):
+        """Hand a frame that reached target to its node."""
+        node = self.nodes[target]
+        opcode, message = decode_frame(frame)
+        if request:
+            reply = node.answer_request(opcode, message)
+            if reply is not None:
+                self.send(target, source, reply)
+        else:
+            for part in node.process_message(opcode, message) or []:
+                self.send(target, source, part, request=True)
+        self.after_event(target)
+
+    def submit(self, node, frame):
+        """Deliver a client frame to a node."""
+        opcode, message = decode_frame(frame)
+        if self.nodes[node].process_message(opcode, message):
+            self.client_replies += 1
+        self.after_event(node)
+
+    def seal(self, node, at):
+        """Seal a partial block whose oldest transaction waited enough."""
+        if (self.seal_at[node] == at):
+            self.seal_at[node] = None
+        self.nodes[node].utxo.start_mining()
+        self.after_event(node)
+
+    def after_event(self, node):
+        """Note new blocks of a node and schedule its next seal check."""
+        block_store = self.nodes[node].utxo.block_store
+        for height in range(self.heights[node], len(block_store)):
+            offset, length, block_hash = block_store.entry(height)
+            self.block_times.setdefault(block_hash, []).append(self.now)
+            self.block_sizes[block_hash] = (length - HEADER_SIZE) // TX_SIZE
+        self.heights[node] = len(block_store)
+        utxo = self.nodes[node].utxo
+        deadline = utxo.seal_deadline()
+        if (deadline is None or utxo.candidate is not None):
+            return  # Checked again once the block being mined is done
+        deadline = max(deadline, self.now) + 1e-6  # Past rounding of due
+        if (self.seal_at[node] is None or deadline < self.seal_at[node]):
+            self.seal_at[node] = deadline
+            self.schedule(deadline, self.seal, node, deadline)
+
+    def run(self, workload, end):
+        """Replay a workload and process events until time end."""
+        for send_time, node, frame in workload:
+            self.schedule(send_time, self.submit, node % len(self.nodes),
+                          frame)
+        while self.events and self.events[0][0] <= end:
+            self.now, _, callback, args = heapq.heappop(self.events)
+            callback(*args)
+        self.now = end
+
+    def main_chain(self):
+        """Block hashes of the chain most nodes ended on."""
+        tips = Counter(node.utxo.block_store.tip_hash()
+                       for node in self.nodes)
+        tip, nodes_on_tip = tips.most_common(1)[0]
+        for node in self.nodes:
+            block_store = node.utxo.block_store
+            if (block_store.tip_hash() == tip):
+                return ([block_store.entry(height)[2]
+                         for height in range(len(block_store))],
+                        nodes_on_tip)
+        return ([], 0)
+
+    def propagation(self, percent):
+        """Seconds for each block to reach percent of the nodes."""
+        needed = max(1, -(-len(self.nodes) * percent // 100))
+        return ([times[needed - 1] - times[0]
+                 for times in self.block_times.values()
+                 if (len(times) >= needed)])
+
+    def results(self, duration):
+        """Summary of the run."""
+        chain, nodes_on_chain = self.main_chain()
+        results = {"blocks_mined": len(self.block_times),
+                   "main_chain_blocks": len(chain),
+                   "nodes_on_main_chain": nodes_on_chain,
+                   "orphan_rate": (1 - len(chain) / len(self.block_times)
+                                   if self.block_times else 0.0),
+                   "confirmed_tx_per_s": sum(self.block_sizes[block_hash]
+                                             for block_hash in chain)
+                   / duration,
+                   "client_replies": self.client_replies,
+                   "messages": dict(self.messages),
+                   "message_bytes": dict(self.message_bytes)}
+        for percent in (50, 90, 100):
+            times = self.propagation(percent)
+            name = "propagation_{}pct".format(percent)
+            results[name + "_median_s"] = percentile(times, 0.5)
+            results[name + "_p90_s"] = percentile(times, 0.9)
+        return (results)
+
+
+def parse_commandline(argv=None):
+    """Handle command line arguments, or argv when given."""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--nodes', type=int, default=50)
+    arg_parser.add_argument('--degree', type=int, default=8,
+                            help="Peers per node, nodes - 1 for a full mesh")
+    arg_parser.add_argument('--latency', type=float, default=50.0,
+                            help="Mean one way link latency in ms")
+    arg_parser.add_argument('--bandwidth', type=float, default=100.0,
+                            help="Link bandwidth in Mbit/s")
+    arg_parser.add_argument('--loss', type=float, default=0.0,
+                            help="Chance a frame has to be resent")
+    arg_parser.add_argument('--rate', type=float, default=200.0,
+                            help="Client transactions per second")
+    arg_parser.add_argument('--batch', type=int, default=20,
+                            help="Transactions per client batch")
+    arg_parser.add_argument('--duration', type=float, default=30.0,
+                            help="Simulated seconds of client traffic")
+    arg_parser.add_argument('--settle', type=float, default=10.0,
+                            help="Simulated seconds to run after traffic")
+    arg_parser.add_argument('--blocktime', type=float, default=5.0,
+                            help="Mean seconds between blocks network wide")
+    arg_parser.add_argument('--numtxinblock', type=int, default=1000)
+    arg_parser.add_argument('--maxblockwait', type=float, default=1.0)
+    arg_parser.add_argument('--difficulty', type=int, default=0,
+                            help="Kept low, nonces are searched for real")
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--workload', default=None,
+                            help="Replay a workload file instead")
+    arg_parser.add_argument('--record', default=None,
+                            help="File to save the workload to")
+    arg_parser.add_argument('--output', default=None,
+                            help="File to write JSON results to")
+    return (arg_parser.parse_args(argv))
+
+
+def main():
+    """Run the network simulation."""
+    arg_list = parse_commandline()
+    start_time = time.perf_counter()
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):  # Node logging
+                network = Network(arg_list, workdir)
+                if arg_list.workload:
+                    workload = read_workload(arg_list.workload)
+                else:
+                    workload = synthetic_workload(arg_list,
+                                                  random.Random(arg_list.seed))
+                if arg_list.record:
+                    write_workload(arg_list.record, workload)
+                end = arg_list.settle + max([send_time for send_time, _, _
+                                             in workload], default=0.0)
+                network.run(workload, end)
+        results = network.results(end)
+    results["sim_s"] = end
+    results["wall_s"] = time.perf_counter() - start_time
+    write_results(arg_list.output, "simulate", vars(arg_list), results)
+
+
+if __name__ == "__main__":
+    main()
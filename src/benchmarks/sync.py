@@ -0,0 +1,116 @@
+"""Benchmark a fresh node catching up on a long chain.
+
+Tasks:
+    Build a chain of many small blocks in a data directory
+    Serve copies of it from several source nodes
+    Time a fresh node syncing from all of them and write the results as JSON
+
+Run from the src directory:
+    python3 -m benchmarks.sync --blocks 2000 --sources 2 --output sync.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+from codec import LENGTH_STRUCT, encode_frame
+from server import GET_BLOCK_OPCODE
+from utxo import UTXO
+from benchmarks.network import connect, receive_exactly, stop_nodes
+from benchmarks.workload import make_transactions, write_results
+
+
+def build_chain(datadir, arg_list):
+    """Mine blocks into datadir, return the size of the block file."""
+    utxo = UTXO(arg_list.numtxinblock, arg_list.difficulty, 0,
+                datadir=datadir)
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for height in range(arg_list.blocks):
+                transactions = make_transactions(
+                    arg_list.numtxinblock, height * arg_list.numtxinblock)
+                utxo.process_batch(memoryview(b''.join(transactions)))
+    utxo.flush()
+    return (os.path.getsize(os.path.join(datadir, "blocks.dat")))
+
+
+def start_node(port, peers, datadir, arg_list, workdir, sync=False):
+    """Launch one node process."""
+    command = [sys.executable, "main.py", "--port", str(port),
+               "--peers", ",".join(str(peer) for peer in peers),
+               "--mode", "asyncio", "--maxblockwait", "0",
+               "--numtxinblock", str(arg_list.numtxinblock),
+               "--difficulty", str(arg_list.difficulty),
+               "--datadir", datadir]
+    if sync:
+        command.append("--sync")
+    log_file = open(os.path.join(workdir, "{}.log".format(port)), "w")
+    return (subprocess.Popen(command, stdout=log_file,
+                             stderr=subprocess.STDOUT))
+
+
+def has_block(port, height):
+    """Check whether a node has the block at height."""
+    node_socket = connect(port, timeout=600.0)  # Listens once synced
+    node_socket.sendall(encode_frame(GET_BLOCK_OPCODE,
+                                     height.to_bytes(32, 'big')))
+    length = LENGTH_STRUCT.unpack(receive_exactly(node_socket,
+                                                  LENGTH_STRUCT.size))[0]
+    receive_exactly(node_socket, length)
+    node_socket.close()
+    return (length > 0)
+
+
+def main():
+    """Run the sync benchmark."""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--blocks', type=int, default=2000)
+    arg_parser.add_argument('--numtxinblock', type=int, default=100)
+    arg_parser.add_argument('--difficulty', type=int, default=1)
+    arg_parser.add_argument('--sources', type=int, default=2,
+                            help="Nodes serving the chain")
+    arg_parser.add_argument('--base-port', type=int, default=9600)
+    arg_parser.add_argument('--output', default=None,
+                            help="File to write JSON results to")
+    arg_list = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        chain_dir = os.path.join(workdir, "chain")
+        build_start = time.time()
+        chain_bytes = build_chain(chain_dir, arg_list)
+        build_time = time.time() - build_start
+
+        ports = [arg_list.base_port + i for i in range(arg_list.sources)]
+        processes = []
+        for port in ports:
+            datadir = os.path.join(workdir, str(port))
+            shutil.copytree(chain_dir, datadir)
+            processes.append(start_node(port, [], datadir, arg_list,
+                                        workdir))
+        for port in ports:
+            connect(port).close()  # Wait for the sources to listen
+
+        sync_port = arg_list.base_port + arg_list.sources
+        sync_start = time.time()
+        processes.append(start_node(sync_port, ports,
+                                    os.path.join(workdir, "fresh"),
+                                    arg_list, workdir, sync=True))
+        synced = has_block(sync_port, arg_list.blocks - 1)
+        sync_time = time.time() - sync_start
+        stop_nodes(ports + [sync_port], processes)
+
+    results = {"synced": synced,
+               "build_s": build_time,
+               "sync_s": sync_time,
+               "blocks_per_s": arg_list.blocks / sync_time,
+               "mb_per_s": chain_bytes / sync_time / 1e6}
+    write_results(arg_list.output, "sync", vars(arg_list), results)
+
+
+if __name__ == "__main__":
+    main()
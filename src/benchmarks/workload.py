@@ -0,0 +1,54 @@
+"""Shared helpers for building benchmark workloads and recording results.
+
+Tasks:
+    Build valid transactions between the default accounts
+    Give mining benchmarks a difficulty no search will meet
+    Time repeated calls and write results as JSON
+"""
+
+import sys
+import json
+import time
+import platform
+from hashlib import sha256
+
+from codec import encode_transaction
+
+NUM_ACCOUNTS = 100  # Accounts created by UTXO.create_utxo
+UNREACHABLE_DIFFICULTY = 64  # Every hex digit must be zero
+
+
+def account(i):
+    """Id of one of the default accounts."""
+    return (sha256(bytes(str(i % NUM_ACCOUNTS), 'ascii')).digest())
+
+
+def make_transactions(count, start=0):
+    """Build count valid, distinct transactions of amount 1."""
+    accounts = [account(i) for i in range(NUM_ACCOUNTS)]
+    return ([encode_transaction(accounts[i % NUM_ACCOUNTS],
+                                accounts[(i + 1) % NUM_ACCOUNTS], 1, i)
+             for i in range(start, start + count)])
+
+
+def rate(function, count, repeat=1):
+    """Items processed per second by function."""
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return ((count * repeat) / (time.perf_counter() - start_time))
+
+
+def write_results(path, benchmark, params, results):
+    """Write benchmark results as JSON so runs can be compared."""
+    report = {"benchmark": benchmark,
+              "time": time.time(),
+              "python": sys.version.split()[0],
+              "platform": platform.platform(),
+              "params": params,
+              "results": results}
+    print(json.dumps(report, indent=2))
+    if path:
+        with open(path, "w") as results_file:
+            json.dump(report, results_file, indent=2)
+    return (report)
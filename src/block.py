@@ -7,7 +7,9 @@ Tasks:
 """
 
 import hashlib
-import multiprocessing as mp
+
+from codec import HEADER_SIZE, TX_SIZE, decode_header
+from miner import MiningEngine, encode_nonce
 
 
 class Block(object):
@@ -16,99 +18,69 @@ class Block(object):
     def __init__(self, difficulty, message_data, numcores):
         """Initialize the UTXO set to handle ledger."""
         self.difficulty = difficulty
-        self.msg_bytearray = message_data  # Original byte array
+        self.msg_bytearray = bytearray(message_data)  # Original byte array
         self.numcores = numcores
-        self.nonce_status = mp.Value('i', 0)  # Checks nonce status
         block_objects = self.parse_block(message_data)
         (self.nonce, self.prior_hash, self.hash, self.block_height,
-         self.miner_address, self.block_data) = block_objects
+         self.miner_address, self.merkle_root,
+         self.block_data) = block_objects
+
+    def hash_prefix(self):
+        """Fixed part of the header that is hashed ahead of the nonce."""
+        # Prior hash, block height, miner address and merkle root
+        return (bytes(self.msg_bytearray[32:64])
+                + self.msg_bytearray[96:HEADER_SIZE])
 
-    def convert_block(self, ascii_input):
-        """Convert specific block attributes to integers."""
-        num = ""
-        for i in range(len(ascii_input) // 2):
-            num += chr(int(ascii_input[2*i:(2*i)+2], 16))
-        return (int(num))
+    def set_solution(self, nonce, digest):
+        """Write mined nonce and hash back into the byte array."""
+        self.nonce = nonce
+        self.hash = digest
+        self.msg_bytearray[0:32] = encode_nonce(nonce)
+        self.msg_bytearray[64:96] = digest
 
     def compute_block_hash(self):
         """Compute hash of current block."""
-        # Obtain attributes of block class to sum hash values
-        nonce_bytes = bytes(str(self.nonce), "ascii")
-        prior_hash_bytes = bytes(str(self.prior_hash), "ascii")
-        block_height_bytes = bytes(str(self.block_height), "ascii")
-        miner_address_bytes = bytes(str(self.miner_address), "ascii")
-        block_data_bytes = bytes(str(self.block_data), "ascii")
-        computed_sum = (nonce_bytes + prior_hash_bytes + block_height_bytes
-                        + miner_address_bytes + block_data_bytes)
-        computed_hash = hashlib.sha256(computed_sum).hexdigest()
-        # Update bytearray with new nonce value
-        computed_hashbytes = bytes.fromhex(computed_hash)
-        self.msg_bytearray = (self.msg_bytearray[0:96] + computed_hashbytes
-                              + self.msg_bytearray[128:])
+        computed_sum = self.hash_prefix() + encode_nonce(self.nonce)
+        computed_hash = hashlib.sha256(computed_sum).digest()
+        # Update bytearray with new hash value
+        self.msg_bytearray[64:96] = computed_hash
         return (computed_hash)
 
     def parse_block(self, byte_message):
         """Parse the byte array of transactions."""
-        hex_message = byte_message.hex()
-        # nonce = int(hex_message[0:64], 16)
-        nonce = self.convert_block(hex_message[0:64])
-        prior_hash = hex_message[64:128]
-        present_hash = hex_message[128:192]
-        # block_height = self.convert_block(hex_message[192:256])
-        # miner_address = self.convert_block(hex_message[256:320])
-        # block_data = self.convert_block(hex_message[320:])
-        block_height = int(hex_message[192:256], 16)
-        miner_address = int(hex_message[256:320], 16)
-        block_data = int(hex_message[320:], 16)
-
+        (nonce, prior_hash, present_hash, block_height, miner_address,
+         merkle_root) = decode_header(byte_message)
+        block_data = memoryview(self.msg_bytearray)[HEADER_SIZE:]
         return (nonce, prior_hash, present_hash, block_height,
-                miner_address, block_data)
+                miner_address, merkle_root, block_data)
 
     def mine_block(self):
         """Mine block once node has a certain number of transactions."""
-        difficulty_zeroes = self.difficulty * "0"  # Number of zeroes needed
+        engine = MiningEngine(self.hash_prefix(), self.difficulty)
         # Mine block until an appropriate nonce has been found
         print("Original nonce: ", self.nonce)
-        while (self.hash[0:self.difficulty] != difficulty_zeroes):
-            self.nonce += 1
-            self.hash = self.compute_block_hash()
-        print ("Block mined.")
+        nonce, digest = engine.run(self.nonce)
+        self.set_solution(nonce, digest)
+        print ("Block mined. Hash rate: {:.0f} H/s".format(engine.hashrate()))
+        return (True)
 
-    def cores_mine_block(self, core_number):
-        """Mine block once node has a certain number of transactions."""
-        difficulty_zeroes = self.difficulty * "0"  # Number of zeroes needed
-        print("Difficulty zeros: ", difficulty_zeroes)
-        # Mine block until an appropriate nonce has been found
+    def mine_blocks(self, mining_pool=None, cancelled=None):
+        """Use the mining pool to spread the nonce search across cores."""
+        if mining_pool is None:
+            return (self.mine_block())
         print("Original nonce: ", self.nonce)
-        print ("Current core: ", core_number)
-        nonce = self.nonce
-        print("Copy of nonce", nonce)
-        while (self.hash[0:self.difficulty] != difficulty_zeroes):
-            nonce += core_number
-            self.hash = self.compute_block_hash()
-        self.nonce_status.value = 1  # Nonce has been found
-        print ("Block mined and nonce found: ", nonce)
-        self.nonce = nonce
-
-    def mine_blocks(self):
-        """Use multiprocessing to enhance block mining."""
-        nonce_processes = []
-        core_range = range(1, self.numcores + 1)
-        while True:
-            if (self.nonce_status.value == 0):
-                for core in core_range:
-                    core_proc = mp.Process(target=self.cores_mine_block,
-                                           args=(core,))
-                    nonce_processes.append(core_proc)
-                    core_proc.start()
-            else:
-                break
-            for process in nonce_processes:  # Terminate processes
-                process.join()
-                # process.terminate()
+        solution = mining_pool.mine(self.hash_prefix(), self.difficulty,
+                                    self.nonce, cancelled)
+        if solution is None:  # Mining was cancelled
+            return (False)
+        self.set_solution(*solution)
+        print ("Block mined on {} cores. Hash rate: {:.0f} H/s".format(
+            mining_pool.numcores, mining_pool.hashrate()))
+        return (True)
 
     def __str__(self):
         """Pretty printing of block for debugging purposes."""
-        return ("\n Nonce: {} -- Prior Hash: {} -- Hash: {} -- Blockheight: {} -- Miner Address: {} -- Blockdata: {}\n".format(
-            self.nonce, self.prior_hash, self.hash, self.block_height,
-            self.miner_address, self.block_data))
+        return ("\n Nonce: {} -- Prior Hash: {} -- Hash: {} -- Blockheight: {} -- Miner Address: {} -- Merkle Root: {} -- Transactions: {}\n".format(
+            self.nonce, self.prior_hash.hex(), self.hash.hex(),
+            self.block_height, self.miner_address, self.merkle_root.hex(),
+            len(self.block_data) // TX_SIZE))
@@ -0,0 +1,118 @@
+"""Keep mined and received blocks on disk instead of in memory.
+
+Tasks:
+    Append serialized blocks to a single segment file
+    Record each block height in a fixed width, memory-mapped index
+    Reload the chain tip from the index without reading any blocks
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+from collections import namedtuple
+
+# Offset and length of the block in the segment file, then its hash
+INDEX_STRUCT = struct.Struct('<QQ32s')
+
+# Part of a file to be copied straight to a socket
+FileRange = namedtuple('FileRange', ['file', 'offset', 'count'])
+
+
+class BlockStore(object):
+    """Append-only block segment file with a height to offset index."""
+
+    def __init__(self, datadir=None):
+        """Open or create the block files in datadir."""
+        if datadir is None:
+            datadir = tempfile.mkdtemp(prefix="blocks")
+        os.makedirs(datadir, exist_ok=True)
+        self.datadir = datadir
+        self.data_file = open(os.path.join(datadir, "blocks.dat"), "a+b")
+        self.index_file = open(os.path.join(datadir, "blocks.idx"), "a+b")
+        self.index = None  # Memory map of the index file
+        self.load_index()
+
+    def load_index(self):
+        """Map the index and drop anything written after the last entry."""
+        index_size = os.fstat(self.index_file.fileno()).st_size
+        self.count = index_size // INDEX_STRUCT.size
+        if (index_size != self.count * INDEX_STRUCT.size):
+            self.index_file.truncate(self.count * INDEX_STRUCT.size)
+        self.map_index()
+        end = 0
+        if self.count:
+            offset, length, _ = self.entry(self.count - 1)
+            end = offset + length
+        # Remove a block whose index entry was never written
+        if (os.fstat(self.data_file.fileno()).st_size > end):
+            self.data_file.truncate(end)
+
+    def map_index(self):
+        """Memory map the current index file."""
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.count:
+            self.index = mmap.mmap(self.index_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        """Number of blocks stored."""
+        return (self.count)
+
+    def entry(self, height):
+        """Return (offset, length, hash) of the block at height."""
+        return (INDEX_STRUCT.unpack_from(self.index,
+                                         height * INDEX_STRUCT.size))
+
+    def tip_hash(self):
+        """Hash of the last stored block, None for an empty chain."""
+        if (self.count == 0):
+            return (None)
+        return (self.entry(self.count - 1)[2])
+
+    def append(self, block_bytes, block_hash):
+        """Store a block at the next height and return that height."""
+        offset = os.fstat(self.data_file.fileno()).st_size
+        self.data_file.write(block_bytes)
+        self.data_file.flush()
+        self.index_file.write(INDEX_STRUCT.pack(offset, len(block_bytes),
+                                                block_hash))
+        self.index_file.flush()
+        self.count += 1
+        self.map_index()
+        return (self.count - 1)
+
+    def read(self, height):
+        """Return the bytes of the block at height."""
+        offset, length, _ = self.entry(height)
+        return (os.pread(self.data_file.fileno(), length, offset))
+
+    def file_range(self, height):
+        """Location of the block at height for sending with sendfile."""
+        offset, length, _ = self.entry(height)
+        return (FileRange(self.data_file, offset, length))
+
+    def read_header(self, height, header_size):
+        """Return the first header_size bytes of the block at height."""
+        offset, _, _ = self.entry(height)
+        return (os.pread(self.data_file.fileno(), header_size, offset))
+
+    def span(self, start, count):
+        """Return (lengths, file range) of count blocks from height start.
+
+        Blocks are appended in height order, so consecutive heights are
+        one contiguous range of the segment file.
+        """
+        lengths = [self.entry(height)[1] for height in range(start,
+                                                             start + count)]
+        offset = self.entry(start)[0]
+        return (lengths, FileRange(self.data_file, offset, sum(lengths)))
+
+    def close(self):
+        """Close the block files."""
+        if self.index is not None:
+            self.index.close()
+        self.data_file.close()
+        self.index_file.close()
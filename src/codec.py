@@ -0,0 +1,201 @@
+"""Encode and decode transactions and block headers on the wire.
+
+Frame layout, carrying messages up to a mempool worth of transactions:
+    VERSION (1) | OPCODE (1 ascii) | LENGTH (4) | MESSAGE (LENGTH)
+
+The version byte is never an ascii opcode, so unframed messages made of an
+opcode and a fixed size message are still understood.
+
+Transaction layout (128 bytes):
+    SENDER (32) | RECEIVER (32) | AMOUNT (32 ascii digits) | TIMESTAMP (32 ascii digits)
+
+Block header layout (192 bytes), followed by the transactions:
+    NONCE (32 ascii digits) | PRIOR HASH (32) | HASH (32) | BLOCK HEIGHT (32) | MINER ADDRESS (32) | MERKLE ROOT (32)
+
+Transaction batch layout, answered with one accept bit per transaction
+(peers forward batches in the same layout without an answer):
+    COUNT (4) | TRANSACTIONS (128 * COUNT)
+
+Block request layout, answered with LENGTH (8) and the block (empty if missing):
+    BLOCK HEIGHT (32)
+
+Transaction proof request layout, answered with LENGTH (8) and the proof:
+    BLOCK HEIGHT (32) | TRANSACTION ID (32)
+
+Transaction request layout, answered with LENGTH (8), BLOCK HEIGHT (8) and
+the transaction (empty if not confirmed):
+    TRANSACTION ID (32)
+
+Compact block layout, the header and a short id for each transaction:
+    HEADER (192) | COUNT (4) | SHORT IDS (8 * COUNT)
+
+Missing transactions request layout, sent back to the node that relayed a
+compact block and answered with a block transactions message:
+    COUNT (4) | BLOCK HEIGHT (8) | BLOCK HASH (32) | POSITIONS (4 * COUNT)
+
+Block transactions layout, in the order they were requested:
+    COUNT (4) | BLOCK HASH (32) | TRANSACTIONS (128 * COUNT)
+
+Header and block range request layout:
+    START HEIGHT (8) | COUNT (4)
+
+Answered for headers with the headers that exist from START HEIGHT on:
+    COUNT (4) | HEADERS (192 * COUNT)
+
+Answered for blocks with their lengths, then the blocks back to back:
+    COUNT (4) | LENGTHS (8 * COUNT) | BLOCKS
+"""
+
+import struct
+
+TX_SIZE = 128
+HEADER_SIZE = 192
+SHORT_ID_SIZE = 8  # Leading bytes of a transaction id used in compact blocks
+
+FRAME_VERSION = 1
+
+FRAME_STRUCT = struct.Struct('>BcI')
+TX_STRUCT = struct.Struct('32s32s32s32s')
+HEADER_STRUCT = struct.Struct('32s32s32s32s32s32s')
+COUNT_STRUCT = struct.Struct('>I')
+LENGTH_STRUCT = struct.Struct('>Q')
+BLOCK_TXS_REQUEST_STRUCT = struct.Struct('>IQ32s')
+BLOCK_TXS_STRUCT = struct.Struct('>I32s')
+POSITION_STRUCT = struct.Struct('>I')
+RANGE_STRUCT = struct.Struct('>QI')
+
+
+def encode_frame(opcode, message=b''):
+    """Wrap a message in a versioned, length prefixed frame."""
+    return (FRAME_STRUCT.pack(FRAME_VERSION, bytes(opcode, "ascii"),
+                              len(message)) + message)
+
+
+def decode_frame_header(buffer):
+    """Return (opcode, message length) from the bytes after the version."""
+    _, opcode, length = FRAME_STRUCT.unpack(bytes([FRAME_VERSION])
+                                            + bytes(buffer))
+    return (chr(opcode[0]), length)
+
+
+def decode_digits(field):
+    """Integer held by an ascii digit field, ValueError for anything else."""
+    if not field.isdigit():  # int() would also take signs and spaces
+        raise ValueError("Not an ascii number: {!r}".format(bytes(field)))
+    return (int(field))
+
+
+def check_digits(batch_data):
+    """Raise ValueError unless every amount and timestamp in a batch is digits."""
+    for _, _, amount, timestamp in TX_STRUCT.iter_unpack(batch_data):
+        if not (amount.isdigit() and timestamp.isdigit()):
+            raise ValueError("Not an ascii number: {!r} {!r}".format(
+                amount, timestamp))
+
+
+def decode_transaction(buffer, offset=0):
+    """Return (sender, receiver, amount, timestamp) from a buffer."""
+    sender, receiver, amount, timestamp = TX_STRUCT.unpack_from(buffer, offset)
+    return (sender, receiver, decode_digits(amount), decode_digits(timestamp))
+
+
+def encode_transaction(sender, receiver, amount, timestamp):
+    """Build the 128 byte message for a transaction."""
+    return (TX_STRUCT.pack(sender, receiver, b'%032d' % amount,
+                           b'%032d' % timestamp))
+
+
+def iter_transactions(block_data):
+    """Yield (sender, receiver, amount, timestamp) for each block transaction."""
+    for sender, receiver, amount, timestamp in TX_STRUCT.iter_unpack(block_data):
+        yield (sender, receiver, decode_digits(amount),
+               decode_digits(timestamp))
+
+
+def decode_header(buffer, offset=0):
+    """Return (nonce, prior_hash, hash, block_height, miner_address, root)."""
+    (nonce, prior_hash, block_hash, block_height, miner_address,
+     merkle_root) = HEADER_STRUCT.unpack_from(buffer, offset)
+    return (int(nonce), prior_hash, block_hash,
+            int.from_bytes(block_height, 'big'),
+            int.from_bytes(miner_address, 'big'), merkle_root)
+
+
+def encode_header(nonce, prior_hash, block_hash, block_height, miner_address,
+                  merkle_root):
+    """Build the 192 byte block header."""
+    return (HEADER_STRUCT.pack(b'%032d' % nonce, prior_hash, block_hash,
+                               block_height.to_bytes(32, 'big'),
+                               miner_address.to_bytes(32, 'big'), merkle_root))
+
+
+def encode_batch(transactions):
+    """Build a batch message from a list of transaction messages."""
+    return (COUNT_STRUCT.pack(len(transactions)) + b''.join(transactions))
+
+
+def encode_bitmap(flags):
+    """Pack accept flags into bits, first transaction in the lowest bit."""
+    bitmap = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return (bytes(bitmap))
+
+
+def short_id(txid):
+    """Short id standing in for a transaction in a compact block."""
+    return (bytes(txid[0:SHORT_ID_SIZE]))
+
+
+def encode_compact_block(header, txids):
+    """Build a compact block from a header and its transaction ids."""
+    return (bytes(header) + COUNT_STRUCT.pack(len(txids))
+            + b''.join(short_id(txid) for txid in txids))
+
+
+def decode_compact_block(buffer):
+    """Return (header, short ids) from a compact block."""
+    count = COUNT_STRUCT.unpack_from(buffer, HEADER_SIZE)[0]
+    start = HEADER_SIZE + COUNT_STRUCT.size
+    if (len(buffer) != start + count*SHORT_ID_SIZE):
+        raise ValueError("Compact block does not hold its short ids")
+    return (bytes(buffer[0:HEADER_SIZE]),
+            [bytes(buffer[start + i*SHORT_ID_SIZE:
+                          start + (i + 1)*SHORT_ID_SIZE])
+             for i in range(count)])
+
+
+def encode_block_txs_request(block_height, block_hash, positions):
+    """Ask for the transactions at positions of a relayed block."""
+    return (BLOCK_TXS_REQUEST_STRUCT.pack(len(positions), block_height,
+                                          block_hash)
+            + b''.join(POSITION_STRUCT.pack(i) for i in positions))
+
+
+def decode_block_txs_request(buffer):
+    """Return (block height, block hash, positions) from a request."""
+    count, block_height, block_hash = BLOCK_TXS_REQUEST_STRUCT.unpack_from(
+        buffer)
+    if (len(buffer) != BLOCK_TXS_REQUEST_STRUCT.size
+            + count*POSITION_STRUCT.size):
+        raise ValueError("Request does not hold its positions")
+    positions = [position for position, in POSITION_STRUCT.iter_unpack(
+        buffer[BLOCK_TXS_REQUEST_STRUCT.size:])]
+    return (block_height, block_hash, positions)
+
+
+def encode_block_txs(block_hash, transactions):
+    """Build the reply carrying requested block transactions."""
+    return (BLOCK_TXS_STRUCT.pack(len(transactions), block_hash)
+            + b''.join(transactions))
+
+
+def decode_block_txs(buffer):
+    """Return (block hash, transaction messages) from a reply."""
+    count, block_hash = BLOCK_TXS_STRUCT.unpack_from(buffer)
+    start = BLOCK_TXS_STRUCT.size
+    if (len(buffer) != start + count*TX_SIZE):
+        raise ValueError("Reply does not hold its transactions")
+    return (block_hash, [bytes(buffer[i:i + TX_SIZE])
+                         for i in range(start, len(buffer), TX_SIZE)])
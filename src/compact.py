@@ -0,0 +1,73 @@
+"""Relay blocks as a header and short transaction ids.
+
+Peers have already received nearly every transaction of a block, so only
+the header and an 8 byte prefix of each transaction id are sent. The
+receiver rebuilds the block from its pending transactions and asks the
+relaying node for the few it is missing. A short id can also match a
+different pending transaction than the one in the block, which only shows
+in the Merkle root, so such a block is fetched again in full.
+
+Tasks:
+    Match short ids against pending transactions
+    Track which positions of a block are still missing
+    Fill in missing transactions and rebuild the full block message
+    Fetch every transaction again when the rebuilt root does not match
+"""
+
+from codec import decode_compact_block, decode_header, short_id
+from mempool import transaction_id
+from merkle import merkle_root
+
+
+def short_id_index(transactions):
+    """Map short id to (txid, bytes) for (txid, bytes) pairs."""
+    index = {}
+    for txid, tx_bytes in transactions:
+        key = short_id(txid)
+        # Two pending transactions share a short id, fetch it instead
+        index[key] = None if key in index else (txid, tx_bytes)
+    return (index)
+
+
+class PartialBlock(object):
+    """Block rebuilt from a compact block, possibly with gaps."""
+
+    def __init__(self, message, index):
+        """Fill positions from index, a short_id_index of pending txs."""
+        self.header, self.short_ids = decode_compact_block(message)
+        (_, _, self.block_hash, self.block_height, _,
+         self.merkle_root) = decode_header(self.header)
+        matches = [index.get(key) for key in self.short_ids]
+        self.txids = [None if match is None else match[0]
+                      for match in matches]
+        self.transactions = [None if match is None else match[1]
+                             for match in matches]
+        self.missing = [position for position, match in enumerate(matches)
+                        if match is None]
+        self.guessed = len(matches) - len(self.missing)  # From short ids
+
+    def check_root(self):
+        """Check the transactions of a complete block hash to its root."""
+        return (merkle_root(self.txids) == self.merkle_root)
+
+    def refetch(self):
+        """Mark every position missing, a short id matched the wrong tx."""
+        self.missing = list(range(len(self.short_ids)))
+        self.guessed = 0
+
+    def fill(self, transactions):
+        """Add requested transactions, False if they do not match."""
+        if (len(transactions) != len(self.missing)):
+            return (False)
+        for position, tx_bytes in zip(self.missing, transactions):
+            txid = transaction_id(tx_bytes)
+            if (short_id(txid) != self.short_ids[position]):
+                return (False)
+            self.txids[position] = txid
+            self.transactions[position] = tx_bytes
+        self.missing = []
+        return (True)
+
+    def message(self):
+        """Full block message once nothing is missing."""
+        return (self.header + b''.join(self.transactions))
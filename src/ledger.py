@@ -0,0 +1,100 @@
+"""Hold account balances in a contiguous array.
+
+Tasks:
+    Intern each 32 byte account id to a dense index once
+    Keep balances in an int64 array addressed by that index
+    Apply the transfers of a whole block at once
+    Snapshot and restore balances through a memory-mapped file
+"""
+
+import os
+import mmap
+import struct
+from array import array
+
+ACCOUNT_SIZE = 32
+# Block height the snapshot was taken at and number of accounts
+SNAPSHOT_STRUCT = struct.Struct('<QQ')
+
+
+class Ledger(object):
+    """Account balances indexed by interned account id."""
+
+    def __init__(self):
+        """Initialize an empty ledger."""
+        self.account_index = {}  # Account id to position in balances
+        self.accounts = []  # Account id at each position
+        self.balances = array('q')
+
+    def __len__(self):
+        """Number of accounts."""
+        return (len(self.accounts))
+
+    def __contains__(self, account):
+        """Check whether an account exists."""
+        return (account in self.account_index)
+
+    def __getitem__(self, account):
+        """Balance of an account."""
+        return (self.balances[self.account_index[account]])
+
+    def __setitem__(self, account, balance):
+        """Set the balance of an account, creating it if needed."""
+        self.balances[self.intern(account)] = balance
+
+    def intern(self, account):
+        """Return the dense index of an account, adding it if new."""
+        index = self.account_index.get(account)
+        if index is None:
+            index = len(self.accounts)
+            self.account_index[account] = index
+            self.accounts.append(bytes(account))
+            self.balances.append(0)
+        return (index)
+
+    def update(self, balances):
+        """Set the balances of several accounts."""
+        for account, balance in balances.items():
+            self[account] = balance
+
+    def apply_transfers(self, transfers):
+        """Debit senders and credit receivers for (sender, receiver, amount)."""
+        account_index = self.account_index
+        balances = self.balances
+        for sender, receiver, amount in transfers:
+            balances[account_index[sender]] -= amount
+            balances[account_index[receiver]] += amount
+
+    def revert_transfers(self, transfers):
+        """Undo transfers applied with apply_transfers."""
+        self.apply_transfers((receiver, sender, amount)
+                             for sender, receiver, amount in transfers)
+
+    def snapshot(self, path, height):
+        """Write balances taken at block height to path atomically."""
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as snapshot_file:
+            snapshot_file.write(SNAPSHOT_STRUCT.pack(height,
+                                                     len(self.accounts)))
+            snapshot_file.write(b''.join(self.accounts))
+            snapshot_file.write(self.balances.tobytes())
+        os.replace(temp_path, path)
+
+    def restore(self, path):
+        """Load a snapshot, returning its block height or None if missing."""
+        if not os.path.exists(path):
+            return (None)
+        with open(path, "rb") as snapshot_file:
+            snapshot = mmap.mmap(snapshot_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        with snapshot:
+            height, count = SNAPSHOT_STRUCT.unpack_from(snapshot)
+            start = SNAPSHOT_STRUCT.size
+            end = start + (count * ACCOUNT_SIZE)
+            ids = snapshot[start:end]
+            self.accounts = [ids[i:i + ACCOUNT_SIZE]
+                             for i in range(0, len(ids), ACCOUNT_SIZE)]
+            self.account_index = dict(zip(self.accounts, range(count)))
+            self.balances = array('q')
+            self.balances.frombytes(snapshot[end:end + (count * 8)])
+        return (height)
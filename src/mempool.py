@@ -0,0 +1,73 @@
+"""Hold transactions that have been accepted but not yet mined.
+
+Tasks:
+    Index pending transactions by transaction id for duplicate checks
+    Keep arrival order so blocks are assembled first come first served
+    Bound the number of pending transactions by refusing new ones when full
+    Remember when each transaction arrived to bound how long it waits
+"""
+
+import time
+from hashlib import sha256
+from collections import OrderedDict
+
+
+def transaction_id(tx_bytes):
+    """Identify a transaction by the hash of its bytes."""
+    return (sha256(tx_bytes).digest())
+
+
+class Mempool(object):
+    """Pending transactions keyed by transaction id."""
+
+    def __init__(self, max_size, clock=time.monotonic):
+        """Initialize an empty pool holding at most max_size transactions.
+
+        clock returns the current time in seconds, a simulated network
+        swaps in its own.
+        """
+        self.max_size = max_size
+        self.clock = clock
+        self.transactions = OrderedDict()  # Transaction id to bytes
+        self.arrivals = {}  # Transaction id to arrival time
+
+    def __len__(self):
+        """Number of pending transactions."""
+        return (len(self.transactions))
+
+    def __contains__(self, txid):
+        """Check whether a transaction id is pending."""
+        return (txid in self.transactions)
+
+    def room(self):
+        """Number of transactions that can still be added."""
+        return (max(0, self.max_size - len(self.transactions)))
+
+    def add(self, txid, tx_bytes):
+        """Add a transaction, callers check there is room first.
+
+        Pending transactions are never evicted, later ones may spend the
+        money they moved.
+        """
+        self.transactions[txid] = bytes(tx_bytes)
+        self.arrivals[txid] = self.clock()
+
+    def remove(self, txids):
+        """Drop transactions that no longer need to be mined."""
+        for txid in txids:
+            self.transactions.pop(txid, None)
+            self.arrivals.pop(txid, None)
+
+    def pop_oldest(self, count):
+        """Remove and return bytes of the oldest count transactions."""
+        count = min(count, len(self.transactions))
+        oldest = [self.transactions.popitem(last=False) for _ in range(count)]
+        for txid, _ in oldest:
+            del self.arrivals[txid]
+        return ([tx_bytes for _, tx_bytes in oldest])
+
+    def oldest_arrival(self):
+        """Arrival time of the oldest pending transaction, None if empty."""
+        if not self.transactions:
+            return (None)
+        return (self.arrivals[next(iter(self.transactions))])
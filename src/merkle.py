@@ -0,0 +1,123 @@
+"""Build Merkle trees over block transactions and prove inclusion.
+
+A node without a sibling at some level is carried up unchanged, so a tree
+of n leaves is made of perfect subtrees for each set bit of n, largest on
+the left. Leaves and inner nodes are hashed behind different prefix bytes,
+so an inner node can never be passed off as a transaction id.
+
+Tasks:
+    Update the root incrementally as transactions enter the pending set
+    Build inclusion proofs for a transaction in a stored block
+    Verify inclusion proofs against a block header root
+"""
+
+from hashlib import sha256
+
+EMPTY_ROOT = bytes(32)  # Root of a tree without leaves
+LEFT = 0  # Sibling is on the left of the running hash
+RIGHT = 1  # Sibling is on the right of the running hash
+LEAF_PREFIX = b'\x00'  # Hashed ahead of a transaction id
+NODE_PREFIX = b'\x01'  # Hashed ahead of two child nodes
+
+
+def merkle_leaf(txid):
+    """Hash a transaction id into its leaf node."""
+    return (sha256(LEAF_PREFIX + txid).digest())
+
+
+def merkle_parent(left, right):
+    """Hash two child nodes into their parent."""
+    return (sha256(NODE_PREFIX + left + right).digest())
+
+
+class IncrementalMerkleTree(object):
+    """Merkle root over appended leaves in O(log n) per leaf."""
+
+    def __init__(self, leaves=()):
+        """Initialize tree, optionally with starting leaves."""
+        self.frontier = []  # Root of the complete subtree at each level
+        self.count = 0
+        for leaf in leaves:
+            self.append(leaf)
+
+    def __len__(self):
+        """Number of leaves."""
+        return (self.count)
+
+    def append(self, leaf):
+        """Add a leaf, merging complete subtrees of equal size."""
+        node = merkle_leaf(leaf)
+        level = 0
+        while (self.count >> level) & 1:
+            node = merkle_parent(self.frontier[level], node)
+            self.frontier[level] = None
+            level += 1
+        if (level == len(self.frontier)):
+            self.frontier.append(node)
+        else:
+            self.frontier[level] = node
+        self.count += 1
+
+    def root(self):
+        """Merkle root of the leaves appended so far."""
+        node = None
+        for subtree in self.frontier:
+            if subtree is None:
+                continue
+            node = subtree if node is None else merkle_parent(subtree, node)
+        return (EMPTY_ROOT if node is None else node)
+
+
+def merkle_levels(leaves):
+    """Every level of the tree from the leaves up to the root."""
+    levels = [[merkle_leaf(leaf) for leaf in leaves]]
+    while (len(levels[-1]) > 1):
+        level = levels[-1]
+        parents = [merkle_parent(level[i], level[i + 1])
+                   for i in range(0, len(level) - 1, 2)]
+        if (len(level) % 2):
+            parents.append(level[-1])  # Carry unpaired node up
+        levels.append(parents)
+    return (levels)
+
+
+def merkle_root(leaves):
+    """Merkle root of a list of leaves."""
+    return (IncrementalMerkleTree(leaves).root())
+
+
+def merkle_proof(leaves, index):
+    """List of (side, sibling) pairs from leaf at index up to the root."""
+    proof = []
+    for level in merkle_levels(leaves)[:-1]:
+        if (index % 2):
+            proof.append((LEFT, level[index - 1]))
+        elif (index + 1 < len(level)):
+            proof.append((RIGHT, level[index + 1]))
+        index //= 2
+    return (proof)
+
+
+def verify_proof(leaf, proof, root):
+    """Check a proof links leaf to root."""
+    node = merkle_leaf(leaf)
+    for side, sibling in proof:
+        if (side == LEFT):
+            node = merkle_parent(sibling, node)
+        else:
+            node = merkle_parent(node, sibling)
+    return (node == root)
+
+
+def encode_proof(index, proof):
+    """Serialize a proof as INDEX (4) followed by SIDE (1) | SIBLING (32)."""
+    return (index.to_bytes(4, 'big')
+            + b''.join(bytes([side]) + sibling for side, sibling in proof))
+
+
+def decode_proof(proof_bytes):
+    """Return (index, proof) from encode_proof output."""
+    index = int.from_bytes(proof_bytes[0:4], 'big')
+    proof = [(proof_bytes[i], bytes(proof_bytes[i + 1:i + 33]))
+             for i in range(4, len(proof_bytes), 33)]
+    return (index, proof)
@@ -0,0 +1,100 @@
+"""Count events and time the hot paths of the node.
+
+Tasks:
+    Keep counters such as transactions accepted and bytes per peer
+    Keep latency histograms with power of two microsecond buckets
+    Print a sample of debug messages when asked to
+    Cost almost nothing when instrumentation is disabled
+"""
+
+import time
+
+NUM_BUCKETS = 32  # Bucket i holds latencies below 2**i microseconds
+
+
+class Histogram(object):
+    """Latency counts in power of two microsecond buckets."""
+
+    def __init__(self):
+        """Initialize empty histogram."""
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0  # Sum of observed seconds
+
+    def observe(self, seconds):
+        """Record one latency."""
+        bucket = min(int(seconds * 1000000).bit_length(), NUM_BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding the percentile."""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return ((1 << bucket) / 1000000.0)
+        return (0.0)
+
+    def snapshot(self):
+        """Summary of the histogram."""
+        mean = self.total / self.count if self.count else 0.0
+        return ({"count": self.count, "mean_s": mean,
+                 "p50_s": self.percentile(0.50),
+                 "p99_s": self.percentile(0.99),
+                 "buckets": self.buckets})
+
+
+class Metrics(object):
+    """Counters, histograms and sampled debug logging."""
+
+    def __init__(self):
+        """Initialize disabled metrics."""
+        self.enabled = False
+        self.debug_sample = 0  # Print one in debug_sample debug messages
+        self.debug_count = 0
+        self.counters = {}
+        self.histograms = {}
+
+    def configure(self, enabled, debug_sample=0):
+        """Turn instrumentation and sampled debug logging on or off."""
+        self.enabled = enabled
+        self.debug_sample = debug_sample
+
+    def incr(self, name, amount=1):
+        """Add amount to a counter."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def start(self):
+        """Start time for a latency, or None when disabled."""
+        if self.enabled:
+            return (time.perf_counter())
+        return (None)
+
+    def observe(self, name, start_time):
+        """Record the time elapsed since start_time."""
+        if start_time is None:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(time.perf_counter() - start_time)
+
+    def debug(self, message, *args):
+        """Print a sample of debug messages."""
+        if self.debug_sample:
+            self.debug_count += 1
+            if (self.debug_count % self.debug_sample == 0):
+                print(message, *args)
+
+    def snapshot(self):
+        """All counters and histogram summaries."""
+        return ({"counters": dict(self.counters),
+                 "histograms": {name: histogram.snapshot() for name, histogram
+                                in self.histograms.items()}})
+
+
+metrics = Metrics()  # Shared by every module of the node
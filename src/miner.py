@@ -0,0 +1,200 @@
+"""Search for a block nonce that satisfies the difficulty.
+
+Tasks:
+    Hash the fixed part of a block once and reuse that midstate per nonce
+    Compare digests against a precomputed byte-level difficulty target
+    Report hashes per second so difficulty can be sized to the hardware
+    Share the nonce search between a persistent pool of worker processes
+    Mine in the background while new transactions keep arriving
+"""
+
+import time
+import hashlib
+import threading
+import multiprocessing as mp
+
+NONCE_SIZE = 32  # Nonce is stored as 32 ascii digits
+BATCH_SIZE = 4096  # Nonces hashed between cancellation checks
+
+
+def difficulty_target(difficulty):
+    """Largest digest allowed for a number of leading zero hex digits."""
+    zero_bits = min(4 * difficulty, 256)
+    return (((1 << (256 - zero_bits)) - 1).to_bytes(32, 'big'))
+
+
+def encode_nonce(nonce):
+    """Encode nonce as fixed width ascii digits."""
+    return (b'%032d' % nonce)
+
+
+class MiningEngine(object):
+    """Hash nonces against a cached midstate of the block."""
+
+    def __init__(self, prefix, difficulty):
+        """Hash the fixed block prefix once."""
+        self.midstate = hashlib.sha256(prefix)
+        self.target = difficulty_target(difficulty)
+        self.hashes = 0  # Nonces tried so far
+        self.elapsed = 0.0  # Seconds spent hashing
+
+    def hash_nonce(self, nonce):
+        """Compute block digest for a single nonce."""
+        state = self.midstate.copy()
+        state.update(encode_nonce(nonce))
+        return (state.digest())
+
+    def search(self, start, count):
+        """Try count nonces from start, return (nonce, digest) or None."""
+        copy = self.midstate.copy
+        target = self.target
+        start_time = time.time()
+        found = None
+        for nonce in range(start, start + count):
+            state = copy()
+            state.update(b'%032d' % nonce)
+            digest = state.digest()
+            if digest <= target:
+                found = (nonce, digest)
+                count = nonce - start + 1
+                break
+        self.hashes += count
+        self.elapsed += time.time() - start_time
+        return (found)
+
+    def run(self, start, stop_event=None, batch_size=BATCH_SIZE):
+        """Search batches of nonces until one is found or mining stops."""
+        nonce = start
+        while stop_event is None or not stop_event.is_set():
+            found = self.search(nonce, batch_size)
+            if found:
+                return (found)
+            nonce += batch_size
+        return (None)
+
+    def hashrate(self):
+        """Hashes per second achieved so far."""
+        if self.elapsed == 0:
+            return (0.0)
+        return (self.hashes / self.elapsed)
+
+
+def mining_worker(worker_index, numworkers, job_queue, result_queue,
+                  stop_event):
+    """Mine disjoint nonce ranges for each job until told to stop."""
+    while True:
+        job = job_queue.get()
+        if job is None:  # Pool is shutting down
+            break
+        prefix, difficulty, start = job
+        engine = MiningEngine(prefix, difficulty)
+        # Worker takes every numworkers-th batch starting from its index
+        nonce = start + (worker_index * BATCH_SIZE)
+        found = None
+        while not stop_event.is_set():
+            found = engine.search(nonce, BATCH_SIZE)
+            if found:
+                stop_event.set()  # Stop the other workers
+                break
+            nonce += numworkers * BATCH_SIZE
+        result_queue.put((found, engine.hashes))
+
+
+class MiningPool(object):
+    """Long-lived worker processes that mine blocks together."""
+
+    def __init__(self, numcores):
+        """Start one mining worker per core."""
+        self.numcores = numcores
+        self.stop_event = mp.Event()  # Set when a nonce is found
+        self.lock = mp.Lock()  # Only one block is mined at a time
+        self.result_queue = mp.Queue()
+        self.job_queues = []
+        self.workers = []
+        for worker_index in range(numcores):
+            job_queue = mp.Queue()
+            worker = mp.Process(target=mining_worker,
+                                args=(worker_index, numcores, job_queue,
+                                      self.result_queue, self.stop_event),
+                                daemon=True)
+            worker.start()
+            self.job_queues.append(job_queue)
+            self.workers.append(worker)
+        self.hashes = 0  # Hashes computed by the last job
+        self.elapsed = 0.0  # Duration of the last job
+        self.active = None  # Cancel event of the job being mined
+
+    def mine(self, prefix, difficulty, start, cancelled=None):
+        """Return (nonce, digest) for the block prefix or None if cancelled."""
+        with self.lock:
+            if cancelled is not None and cancelled.is_set():
+                return (None)  # Cancelled while waiting for the workers
+            start_time = time.time()
+            self.active = cancelled
+            self.stop_event.clear()
+            # A cancel racing with the clear above is still seen here
+            if cancelled is not None and cancelled.is_set():
+                self.stop_event.set()
+            for job_queue in self.job_queues:
+                job_queue.put((prefix, difficulty, start))
+            # Every worker reports once it has stopped
+            solution = None
+            self.hashes = 0
+            for _ in self.workers:
+                found, hashes = self.result_queue.get()
+                self.hashes += hashes
+                if found and solution is None:
+                    solution = found
+            self.elapsed = time.time() - start_time
+            self.active = None
+            return (solution)
+
+    def cancel(self, cancelled=None):
+        """Stop the job of the cancel event, or whichever job is running."""
+        if cancelled is not None:
+            cancelled.set()
+            if self.active is not cancelled:  # Job not started or finished
+                return
+        self.stop_event.set()
+
+    def hashrate(self):
+        """Hashes per second achieved by the last job."""
+        if self.elapsed == 0:
+            return (0.0)
+        return (self.hashes / self.elapsed)
+
+    def close(self):
+        """Shut down the mining workers."""
+        self.cancel()
+        for job_queue in self.job_queues:
+            job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class BackgroundMiner(object):
+    """Mine candidate blocks on a thread so ingest keeps running."""
+
+    def __init__(self, mining_pool, on_mined):
+        """Initialize miner that reports mined blocks to on_mined."""
+        self.mining_pool = mining_pool
+        self.on_mined = on_mined  # Called from the mining thread
+        self.cancelled = None  # Cancel event of the latest job
+
+    def start(self, block):
+        """Start mining block in the background."""
+        self.cancelled = threading.Event()
+        thread = threading.Thread(target=self.run,
+                                  args=(block, self.cancelled), daemon=True)
+        thread.start()
+        return (thread)
+
+    def run(self, block, cancelled):
+        """Mine block and report it unless mining was cancelled."""
+        if block.mine_blocks(self.mining_pool, cancelled):
+            self.on_mined(block)
+
+    def cancel(self):
+        """Stop the block currently being mined."""
+        if self.cancelled is not None:
+            self.mining_pool.cancel(self.cancelled)
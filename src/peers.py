@@ -0,0 +1,169 @@
+"""Keep connections to peer nodes open and forward messages to them.
+
+Tasks:
+    Hold one long-lived connection per peer, reconnecting with backoff
+    Queue outbound messages per peer and flush them in coalesced batches
+    Bound each queue so a slow peer cannot stall the rest of the node
+    Answer requests peers send back over our connections to them
+"""
+
+import time
+import socket
+import threading
+from collections import deque
+
+MAX_QUEUED_BYTES = 64 * 1024 * 1024  # Per peer limit before dropping
+MAX_BATCH = 1024  # Buffers handed to a single sendmsg call
+MIN_BACKOFF = 0.1  # Seconds before the first reconnect attempt
+MAX_BACKOFF = 5.0  # Longest wait between reconnect attempts
+
+
+class PeerConnection(object):
+    """Outbound queue and sender thread for a single peer."""
+
+    def __init__(self, port, max_queued_bytes=MAX_QUEUED_BYTES,
+                 on_request=None):
+        """Start the sender thread for a peer listening on port."""
+        self.port = port
+        self.max_queued_bytes = max_queued_bytes
+        # Reads one request from the socket and returns the reply to queue
+        self.on_request = on_request
+        self.queue = deque()  # Messages waiting to be sent
+        self.queued_bytes = 0
+        self.dropped = 0  # Messages dropped because the queue was full
+        self.sent_bytes = 0
+        self.condition = threading.Condition()
+        self.closing = False
+        self.socket = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        """Queue a message without blocking, return False if dropped."""
+        with self.condition:
+            if (self.queued_bytes + len(message) > self.max_queued_bytes):
+                self.dropped += 1
+                return (False)
+            self.queue.append(message)
+            self.queued_bytes += len(message)
+            self.condition.notify()
+        return (True)
+
+    def connect(self):
+        """Connect to the peer, backing off while it is unavailable."""
+        backoff = MIN_BACKOFF
+        while not self.closing:
+            try:
+                peer_socket = socket.create_connection(('localhost',
+                                                        self.port))
+                peer_socket.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+                print("Connected to peer: ", self.port)
+                if self.on_request is not None:
+                    threading.Thread(target=self.serve_requests,
+                                     args=(peer_socket,), daemon=True).start()
+                return (peer_socket)
+            except OSError:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+        return (None)
+
+    def serve_requests(self, peer_socket):
+        """Answer requests until the peer closes the connection."""
+        try:
+            while True:
+                reply = self.on_request(peer_socket)
+                if reply is None:
+                    break
+                self.send(reply)
+        except OSError:
+            pass  # Sender thread dropped the connection
+        except ValueError as error:
+            print("Bad request from peer: ", self.port, error)
+
+    def next_batch(self):
+        """Wait for queued messages and take up to MAX_BATCH of them."""
+        with self.condition:
+            while not self.queue and not self.closing:
+                self.condition.wait()
+            batch = []
+            while self.queue and len(batch) < MAX_BATCH:
+                batch.append(self.queue.popleft())
+            return (batch)
+
+    def requeue(self, batch):
+        """Put unsent messages back at the front of the queue."""
+        with self.condition:
+            self.queue.extendleft(reversed(batch))
+
+    def send_batch(self, batch):
+        """Write queued messages with as few system calls as possible.
+
+        When the connection fails, messages not fully written are queued
+        again whole. The part already written is lost with the connection,
+        so a peer never reads a frame starting from its middle.
+        """
+        buffers = [memoryview(message) for message in batch]
+        done = 0  # Messages written in full
+        try:
+            while buffers:
+                sent = self.socket.sendmsg(buffers)
+                self.sent_bytes += sent
+                # Drop buffers that were fully written, trim a partial one
+                while buffers and sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                    done += 1
+                if sent:
+                    buffers[0] = buffers[0][sent:]
+        except OSError:
+            self.requeue(batch[done:])
+            raise
+        finally:
+            with self.condition:
+                self.queued_bytes -= sum(len(message)
+                                         for message in batch[0:done])
+
+    def run(self):
+        """Send queued messages until the connection is closed."""
+        while True:
+            batch = self.next_batch()
+            if not batch:  # Closing and nothing left to send
+                break
+            if self.socket is None:
+                self.socket = self.connect()
+                if self.socket is None:
+                    break
+            try:
+                self.send_batch(batch)
+            except OSError:
+                print("Lost connection to peer: ", self.port)
+                self.socket.close()  # Unsent messages go out on reconnect
+                self.socket = None
+        if self.socket is not None:
+            self.socket.close()
+
+    def close(self, timeout=5.0):
+        """Flush what is queued and stop the sender thread."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
+
+class PeerManager(object):
+    """Broadcast messages to every peer over persistent connections."""
+
+    def __init__(self, peers, on_request=None):
+        """Open a connection to each peer port."""
+        self.connections = [PeerConnection(int(peer), on_request=on_request)
+                            for peer in peers]
+
+    def broadcast(self, message):
+        """Queue message for every peer without waiting on the network."""
+        for connection in self.connections:
+            connection.send(message)
+
+    def close(self):
+        """Flush and close every peer connection."""
+        for connection in self.connections:
+            connection.close()
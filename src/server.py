@@ -6,41 +6,101 @@ Tasks:
     Broadcast transactions to peers
 """
 
+import os
+import json
 import time
 import socket
+import asyncio
 import argparse
+import threading
 import multiprocessing as mp
 
 from transaction import Transaction
 from block import Block
+from blockstore import FileRange
+from codec import (BLOCK_TXS_REQUEST_STRUCT, BLOCK_TXS_STRUCT, COUNT_STRUCT,
+                   FRAME_STRUCT, FRAME_VERSION, HEADER_SIZE, LENGTH_STRUCT,
+                   POSITION_STRUCT, RANGE_STRUCT, SHORT_ID_SIZE, TX_SIZE,
+                   decode_block_txs, decode_frame_header, encode_batch,
+                   encode_bitmap, encode_block_txs_request, encode_frame)
+from metrics import metrics
+from miner import BackgroundMiner, MiningPool
+from peers import PeerManager
+from sync import ChainSyncer, GET_BLOCKS_OPCODE, GET_HEADERS_OPCODE
 from utxo import UTXO
+from validator import BlockValidator
 
 # Opcode variables to create mapping between message size
 TX_OPCODE = "0"
 CLOSE_OPCODE = "1"
 BLOCK_OPCODE = "2"
 GET_BLOCK_OPCODE = "3"
+TX_BATCH_OPCODE = "4"
+STATS_OPCODE = "5"
+GET_TX_PROOF_OPCODE = "6"
+GET_TX_OPCODE = "7"
+COMPACT_BLOCK_OPCODE = "8"
+GET_BLOCK_TXS_OPCODE = "9"
+BLOCK_TXS_OPCODE = "A"
+RELAY_BATCH_OPCODE = "B"  # Batch forwarded by a peer, not answered
+# GET_HEADERS_OPCODE "C" and GET_BLOCKS_OPCODE "D" come from sync
+
+ACCEPT_TIMEOUT = 0.5  # Seconds between checks of the close status
+
+# Offset of the item count in the fixed part and size of each item
+ITEM_SIZES = {TX_BATCH_OPCODE: (0, TX_SIZE),
+              RELAY_BATCH_OPCODE: (0, TX_SIZE),
+              COMPACT_BLOCK_OPCODE: (HEADER_SIZE, SHORT_ID_SIZE),
+              GET_BLOCK_TXS_OPCODE: (0, POSITION_STRUCT.size),
+              BLOCK_TXS_OPCODE: (0, TX_SIZE)}
 
 
 class Server(object):
     """Initialize sockets to receive and transmit blockchain data."""
 
-    def __init__(self):
-        """Initialize the server to handle information."""
-        parser_arguments = self.parse_commandline()
+    def __init__(self, argv=None, listen=True, peer_manager=None):
+        """Initialize the server to handle information.
+
+        argv replaces the command line arguments. Without listen the node
+        has no socket or mining workers and is driven by calling
+        process_message, as the network simulator does. peer_manager
+        replaces the connections to peers, opened on first use otherwise.
+        """
+        parser_arguments = self.parse_commandline(argv)
         (self.port, self.peers, self.difficulty,
-         self.numtxinblock, self.numcores) = parser_arguments
-        self.utxo = UTXO(self.numtxinblock, self.difficulty, self.numcores)
+         self.numtxinblock, self.numcores, self.mode,
+         self.datadir, self.max_block_wait, self.shards,
+         self.sync) = parser_arguments
+        self.mining_pool = self.create_mining_pool() if listen else None
+        self.utxo = UTXO(self.numtxinblock, self.difficulty, self.numcores,
+                         self.mining_pool, self.datadir, self.max_block_wait,
+                         self.shards)
+        # Largest message read, a block or batch as big as the mempool
+        self.max_message_size = (HEADER_SIZE
+                                 + TX_SIZE * self.utxo.mempool.max_size)
+        if listen:
+            self.utxo.background_miner = BackgroundMiner(self.mining_pool,
+                                                         self.on_block_mined)
+        self.state_lock = threading.Lock()  # Ingest and mined block commits
+        self.validator = BlockValidator(self.utxo, self.difficulty,
+                                        self.numcores)
         self.message_map = self.message_mapping()  # Opcodes and message sizes
-        self.socket = self.create_socket()
         self.close_status = mp.Value('i', 0)  # Checks close status
-        self.socket_list = []  # Hold sockets for peers
-        self.broadcasting = True
-        self.listen_socket()  # Listen for clients
-        # self.create_peer_sockets()  # Connect peer sockets for broadcasting
+        self.peer_manager = peer_manager  # Persistent connections to peers
+        self.partial_blocks = {}  # Compact blocks waiting on transactions
+        self.sealer = None  # Thread running the block sealing timer
+        if not listen:
+            return
+        self.socket = self.create_socket()
+        if (self.mode == "asyncio"):
+            asyncio.run(self.serve_asyncio())  # Handle clients in one loop
+        else:
+            if self.sync:
+                asyncio.run(self.sync_chain())
+            self.listen_socket()  # Listen for clients
 
-    def parse_commandline(self):
-        """Handle command line arguments."""
+    def parse_commandline(self, argv=None):
+        """Handle command line arguments, or argv when given."""
         arg_parser = argparse.ArgumentParser()
         arg_parser.add_argument('--port', help="Port node is listening on",
                                 required=True)
@@ -49,28 +109,136 @@ class Server(object):
         arg_parser.add_argument('--difficulty', help="Number of leading bytes",
                                 default=0, required=False)
         arg_parser.add_argument('--numtxinblock', default=50000,
-                                help="Transactions in a block", required=False)
+                                help="Most transactions in a block",
+                                required=False)
+        arg_parser.add_argument('--maxblockwait', default=10.0,
+                                help="Seconds before a partial block is "
+                                "sealed, 0 to only seal full blocks",
+                                required=False)
         arg_parser.add_argument('--numcores', default=0,
                                 help="Number of cores", required=False)
+        arg_parser.add_argument('--mode', default="process",
+                                choices=["process", "asyncio"],
+                                help="A thread per connection in the node "
+                                "process, or every connection in an "
+                                "asyncio loop",
+                                required=False)
+        arg_parser.add_argument('--datadir', default=None,
+                                help="Directory holding the block store",
+                                required=False)
+        arg_parser.add_argument('--shards', default=1,
+                                help="Worker processes holding account "
+                                "balances",
+                                required=False)
+        arg_parser.add_argument('--sync', action='store_true',
+                                help="Catch up with peers before serving")
+        arg_parser.add_argument('--metrics', action='store_true',
+                                help="Collect counters and latencies")
+        arg_parser.add_argument('--debugsample', default=0,
+                                help="Print one in this many debug messages",
+                                required=False)
 
         # List of arguments
         print("Parsing arguments.")
-        arg_list = arg_parser.parse_args()
+        arg_list = arg_parser.parse_args(argv)
         port = int(arg_list.port)
-        peers = arg_list.peers.split(',')
+        peers = [peer for peer in arg_list.peers.split(',') if peer]
         difficulty = int(arg_list.difficulty)
         numtxinblock = int(arg_list.numtxinblock)
         numcores = int(arg_list.numcores)
+        metrics.configure(arg_list.metrics, int(arg_list.debugsample))
+
+        datadir = arg_list.datadir
+        if datadir is None:
+            datadir = os.path.join("data", str(port))
+        max_block_wait = float(arg_list.maxblockwait) or None
+        shards = max(1, int(arg_list.shards))
 
-        return (port, peers, difficulty, numtxinblock, numcores)
+        return (port, peers, difficulty, numtxinblock, numcores,
+                arg_list.mode, datadir, max_block_wait, shards,
+                arg_list.sync)
+
+    def create_mining_pool(self):
+        """Start mining workers once so every block reuses them."""
+        # At least one worker so mining never runs on the ingest path
+        return (MiningPool(max(1, self.numcores)))
+
+    def on_block_mined(self, block):
+        """Commit and broadcast a block mined in the background."""
+        with self.state_lock:
+            if not self.utxo.commit_mined_block(block):
+                return  # A competing block arrived first
+            self.relay_block(block)
+            self.utxo.start_mining()  # Next block may already be full
+
+    def start_sealer(self):
+        """Start the block sealing timer on first use."""
+        if (self.max_block_wait is None or self.sealer is not None):
+            return
+        self.sealer = threading.Thread(target=self.seal_blocks, daemon=True)
+        self.sealer.start()
+
+    def seal_blocks(self):
+        """Seal a partial block once its oldest transaction waited enough."""
+        while True:
+            with self.state_lock:
+                self.utxo.start_mining()
+                deadline = self.utxo.seal_deadline()
+            delay = self.max_block_wait
+            if deadline is not None and deadline > time.monotonic():
+                delay = deadline - time.monotonic()
+            time.sleep(delay)
 
     def message_mapping(self):
-        """Opcodes for message types and respective size mapping."""
-        message_size = {TX_OPCODE: 128, CLOSE_OPCODE: 0,
-                        BLOCK_OPCODE: (160 + (128*self.numtxinblock)),
-                        GET_BLOCK_OPCODE: 32}
+        """Opcodes for message types and respective size mapping.
+
+        Unframed blocks must hold exactly numtxinblock transactions.
+        """
+        message_size = {TX_OPCODE: TX_SIZE, CLOSE_OPCODE: 0,
+                        BLOCK_OPCODE: (HEADER_SIZE
+                                       + (TX_SIZE*self.numtxinblock)),
+                        GET_BLOCK_OPCODE: 32,
+                        TX_BATCH_OPCODE: COUNT_STRUCT.size,
+                        STATS_OPCODE: 0,
+                        GET_TX_PROOF_OPCODE: 64,
+                        GET_TX_OPCODE: 32,
+                        COMPACT_BLOCK_OPCODE: HEADER_SIZE + COUNT_STRUCT.size,
+                        GET_BLOCK_TXS_OPCODE: BLOCK_TXS_REQUEST_STRUCT.size,
+                        BLOCK_TXS_OPCODE: BLOCK_TXS_STRUCT.size,
+                        RELAY_BATCH_OPCODE: COUNT_STRUCT.size,
+                        GET_HEADERS_OPCODE: RANGE_STRUCT.size,
+                        GET_BLOCKS_OPCODE: RANGE_STRUCT.size}
         return (message_size)
 
+    def extra_size(self, opcode, current_message):
+        """Bytes following the fixed part of variable sized messages."""
+        if opcode in ITEM_SIZES:
+            offset, item_size = ITEM_SIZES[opcode]
+            return (item_size
+                    * COUNT_STRUCT.unpack_from(current_message, offset)[0])
+        return (0)
+
+    def frame_allowed(self, opcode, length):
+        """Check an opcode and message length before reading the message."""
+        if opcode not in self.message_map or length > self.max_message_size:
+            print("Bad frame: ", opcode, length)
+            return (False)
+        return (True)
+
+    def check_frame(self, opcode, current_message):
+        """Check a framed message has the size its opcode calls for."""
+        size = len(current_message)
+        if (opcode == BLOCK_OPCODE):  # Any number of transactions
+            valid = (size >= HEADER_SIZE
+                     and (size - HEADER_SIZE) % TX_SIZE == 0)
+        else:
+            fixed = self.message_map[opcode]
+            valid = (size >= fixed and size == fixed
+                     + self.extra_size(opcode, current_message))
+        if not valid:
+            print("Bad frame: ", opcode, size)
+        return (valid)
+
     def create_socket(self):
         """Initialize socket for node to begin receiving requests."""
         new_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -79,116 +247,394 @@ class Server(object):
         return (new_socket)
 
     def listen_socket(self):
-        """Listen for new clients individually."""
+        """Listen for new clients, serving each on its own thread.
+
+        Threads of the node process share the ledger and block store under
+        the state lock. Peers keep their connections open, so serving
+        connections in turn would stall on the first peer.
+        """
         self.socket.listen(10)
+        self.socket.settimeout(ACCEPT_TIMEOUT)
         print("Socket is listening on port: ", self.port)
-        process_queue = []  # Create queue to hold processes
-        while True:
-            if(self.close_status.value == 0):
+        while (self.close_status.value == 0):
+            try:
                 client, address = self.socket.accept()
-                print("Connection received from: ", address)
-                cur_process = mp.Process(target=self.connect_socket,
-                                         args=(client, address))
-                process_queue.append(cur_process)  # Hold processes
-                cur_process.start()
-            else:
-                print("Received close message.")
-                break   # If close has been called, stop listening
-            for p in process_queue:
-                p.join()
+            except socket.timeout:
+                continue  # Check whether a client asked to close
+            print("Connection received from: ", address)
+            threading.Thread(target=self.connect_socket,
+                             args=(client, address), daemon=True).start()
+        print("Received close message.")
+        self.close_peer_sockets()  # Peer connections outlive each client
+        self.close()
+
+    async def sync_chain(self):
+        """Download the blocks our peers have beyond our tip."""
+        start_time = time.time()
+        syncer = ChainSyncer(self.peers, self.validator, self.sync_block)
+        count = await syncer.run()
+        with self.state_lock:
+            self.utxo.flush()  # Blocks synced since the last interval
+        print("Synced {} blocks in {:.2f}s".format(count,
+                                                  time.time() - start_time))
+
+    def sync_block(self, message, block_hash):
+        """Validate and store a block fetched while syncing."""
+        block = Block(self.difficulty, message, self.numcores)
+        if (block.hash != block_hash):  # Body does not match its header
+            return (False)
+        with self.state_lock:
+            return (self.validator.validate_block(block))
+
+    async def serve_asyncio(self):
+        """Handle every client concurrently against one shared ledger."""
+        if self.sync:
+            await self.sync_chain()
+        self.close_event = asyncio.Event()
+        self.socket.listen(100)
+        self.socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_client,
+                                            sock=self.socket)
+        print("Socket is listening on port: ", self.port)
+        async with server:
+            await self.close_event.wait()  # Serve until close message
+        print("Received close message.")
+        self.close_peer_sockets()
+        self.close()
+
+    async def handle_client(self, reader, writer):
+        """Read framed messages from one client until it disconnects."""
+        start_time = time.time()  # Start recording time
+        client_address = writer.get_extra_info('peername')
+        print("Connection received from: ", client_address)
+        bytes_in = "bytes_in.{}:{}".format(*client_address)
+        try:
+            while True:
+                opcode_byte = await reader.readexactly(1)
+                if (opcode_byte[0] == FRAME_VERSION):
+                    opcode, length = decode_frame_header(
+                        await reader.readexactly(FRAME_STRUCT.size - 1))
+                    if not self.frame_allowed(opcode, length):
+                        break
+                    current_message = await reader.readexactly(length)
+                    if not self.check_frame(opcode, current_message):
+                        break
+                else:
+                    opcode = chr(opcode_byte[0])
+                    if opcode not in self.message_map:
+                        print("Unknown opcode: ", opcode)
+                        break
+                    current_message = await reader.readexactly(
+                        self.message_map.get(opcode))
+                    extra = self.extra_size(opcode, current_message)
+                    if not self.frame_allowed(opcode, len(current_message)
+                                              + extra):
+                        break
+                    if extra:
+                        current_message += await reader.readexactly(extra)
+                metrics.incr(bytes_in, 1 + len(current_message))
+                reply = self.handle_message(opcode, current_message)
+                if reply:
+                    await self.write_reply(writer, reply)
+                if (opcode == CLOSE_OPCODE):
+                    self.close_event.set()
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # Client has finished sending
+        except ValueError as error:
+            print("Bad message: ", error)  # Drop the client, not the node
+        except asyncio.CancelledError:
+            pass  # Node is closing down
+        finally:
+            writer.close()
+        work_time = time.time() - start_time  # Compute duration of client
+        print ("Time to run blockchain: ", work_time)
 
     def create_peer_sockets(self):
-        """Create sockets for each peer node."""
-        for peer in self.peers:  # Broadcast to all peers in list
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            print("Connecting to peer: ", peer)
-            peer_socket.connect(('localhost', int(peer)))
-            self.socket_list.append(peer_socket)  # Add socket to list
-        print("Peer socket list: ", self.socket_list)
+        """Start the peer manager on first use."""
+        if self.peer_manager is None:
+            self.peer_manager = PeerManager(self.peers, self.answer_peer)
+        return (self.peer_manager)
 
     def broadcast_message(self, message):
         """Share transactions/blocks with peer nodes."""
-        for peer_socket in self.socket_list:  # Broadcast to all peers in list
-            print ("Broadcasting to peer socket.")
-            peer_socket.send(message)
-            print ("Broadcasting to peer finished.")
+        start_time = metrics.start()
+        self.create_peer_sockets().broadcast(message)
+        metrics.observe("broadcast", start_time)
+
+    def relay_block(self, block):
+        """Send peers a compact block, they ask for what they are missing."""
+        compact = self.utxo.compact_block(block)
+        metrics.incr("compact_block_bytes", len(compact))
+        self.broadcast_message(encode_frame(COMPACT_BLOCK_OPCODE, compact))
+
+    def answer_peer(self, peer_socket):
+        """Answer a request a peer sends back over our connection to it."""
+        message = self.process_data_bytes(peer_socket)
+        if message is None:
+            return (None)
+        return (self.answer_request(*message))
+
+    def answer_request(self, opcode, current_message):
+        """Reply to one request read from our connection to a peer."""
+        if (opcode != GET_BLOCK_TXS_OPCODE):
+            print("Unexpected peer request: ", opcode)
+            return (None)
+        metrics.incr("block_txs_requests")
+        with self.state_lock:
+            return (encode_frame(BLOCK_TXS_OPCODE,
+                                 self.utxo.process_get_block_txs(
+                                     current_message)))
+
+    def accept_block(self, message):
+        """Validate a received block, relay it and mine on the new tip."""
+        received_block = Block(self.difficulty, message, self.numcores)
+        print("Block received: ", received_block)
+        if self.validator.validate_block(received_block):
+            self.partial_blocks.clear()  # They no longer extend the tip
+            # Peers that already have it drop it at the header check
+            self.relay_block(received_block)
+        self.utxo.start_mining()
+
+    def receive_compact_block(self, message):
+        """Rebuild a compact block, asking the relaying peer for gaps."""
+        header = Block(self.difficulty, message[0:HEADER_SIZE],
+                       self.numcores)
+        # Check the header before spending anything on the transactions
+        if not (self.validator.check_header(header)
+                and self.validator.check_proof_of_work(header)):
+            print("Compact block rejected: ", header.block_height)
+            return (None)
+        partial = self.utxo.rebuild_compact_block(message)
+        metrics.incr("compact_blocks")
+        return (self.complete_block(partial))
+
+    def receive_block_txs(self, message):
+        """Complete a compact block with the transactions we asked for."""
+        block_hash, transactions = decode_block_txs(message)
+        partial = self.partial_blocks.pop(block_hash, None)
+        if partial is None:
+            return (None)  # Block was already accepted or superseded
+        if not partial.fill(transactions):
+            print("Compact block rejected: missing transactions not sent")
+            return (None)
+        return (self.complete_block(partial))
+
+    def complete_block(self, partial):
+        """Accept a rebuilt block, or ask the relaying peer for its gaps."""
+        if (not partial.missing and partial.guessed
+                and not partial.check_root()):
+            # A short id matched another pending transaction, fetch them all
+            metrics.incr("compact_block_collisions")
+            partial.refetch()
+        if not partial.missing:
+            self.accept_block(partial.message())
+            return (None)
+        metrics.incr("compact_block_missing_txs", len(partial.missing))
+        self.partial_blocks[partial.block_hash] = partial
+        return ([encode_frame(GET_BLOCK_TXS_OPCODE,
+                              encode_block_txs_request(partial.block_height,
+                                                       partial.block_hash,
+                                                       partial.missing))])
+
+    def process_stats(self):
+        """Snapshot of the node metrics as a length prefixed JSON reply."""
+        stats = metrics.snapshot()
+        stats["peers"] = {}
+        if self.peer_manager is not None:
+            for connection in self.peer_manager.connections:
+                stats["peers"][connection.port] = {
+                    "bytes_out": connection.sent_bytes,
+                    "queued_bytes": connection.queued_bytes,
+                    "dropped": connection.dropped}
+        stats_bytes = json.dumps(stats).encode("ascii")
+        return ([LENGTH_STRUCT.pack(len(stats_bytes)), stats_bytes])
 
     def close_peer_sockets(self):
-        """Close list of peer sockets."""
-        for peer_socket in self.socket_list:
-            peer_socket.close()
+        """Flush queued messages and close peer connections."""
+        if self.peer_manager is not None:
+            self.peer_manager.close()
+            self.peer_manager = None
+
+    def receive_exactly(self, client_socket, size):
+        """Receive size bytes, waiting for short reads to complete."""
+        message = bytearray(size)
+        view = memoryview(message)
+        received = 0
+        while (received < size):
+            count = client_socket.recv_into(view[received:])
+            if (count == 0):
+                return (None)  # Connection closed mid message
+            received += count
+        return (message)
 
     def process_data_bytes(self, client_socket):
-        """Only receive bytes of a certain message."""
-        # Receive first byte, check it then receive more
-        # If this is done, no need to truncate data
+        """Receive one opcode byte and the message that follows it."""
         receiving_data = client_socket.recv(1)
-        message = bytearray()
-        message.extend(receiving_data)
-        if (len(message) > 0):
-            opcode = chr(int(message[0:1].hex(), 16))  # Check opcode of byte
-            message.extend(client_socket.recv(self.message_map.get(opcode)))
-            # print("Error!")
-        return (message)
+        if (len(receiving_data) == 0):
+            return (None)
+        if (receiving_data[0] == FRAME_VERSION):
+            return (self.receive_frame(client_socket))
+        opcode = chr(receiving_data[0])
+        if opcode not in self.message_map:
+            print("Unknown opcode: ", opcode)
+            return (None)
+        current_message = self.receive_exactly(client_socket,
+                                               self.message_map.get(opcode))
+        extra = 0
+        if current_message is not None:
+            extra = self.extra_size(opcode, current_message)
+            if not self.frame_allowed(opcode, len(current_message) + extra):
+                return (None)
+        if extra:
+            remainder = self.receive_exactly(client_socket, extra)
+            if remainder is None:
+                return (None)
+            current_message += remainder
+        if current_message is None:
+            return (None)
+        return (opcode, current_message)
+
+    def receive_frame(self, client_socket):
+        """Receive the rest of a frame once its version byte is read."""
+        frame_header = self.receive_exactly(client_socket,
+                                            FRAME_STRUCT.size - 1)
+        if frame_header is None:
+            return (None)
+        opcode, length = decode_frame_header(frame_header)
+        if not self.frame_allowed(opcode, length):
+            return (None)
+        current_message = self.receive_exactly(client_socket, length)
+        if (current_message is None
+                or not self.check_frame(opcode, current_message)):
+            return (None)
+        return (opcode, current_message)
+
+    def send_reply(self, client_socket, reply):
+        """Send reply parts, copying file ranges without reading them."""
+        for part in reply:
+            if isinstance(part, FileRange):
+                offset = part.offset
+                end = part.offset + part.count
+                while (offset < end):
+                    offset += os.sendfile(client_socket.fileno(),
+                                          part.file.fileno(), offset,
+                                          end - offset)
+            else:
+                client_socket.sendall(part)
+
+    async def write_reply(self, writer, reply):
+        """Write reply parts to an asyncio stream."""
+        loop = asyncio.get_running_loop()
+        for part in reply:
+            if isinstance(part, FileRange):
+                await writer.drain()
+                await loop.sendfile(writer.transport, part.file, part.offset,
+                                    part.count)
+            else:
+                writer.write(part)
+        await writer.drain()
+
+    def handle_message(self, opcode, current_message):
+        """Execute the action for one message and return reply parts."""
+        with self.state_lock:
+            self.start_sealer()
+            return (self.process_message(opcode, current_message))
+
+    def process_message(self, opcode, current_message):
+        """Apply one message to the node state."""
+        metrics.debug("Current opcode: ", opcode)
+        reply = None
+        block = None
+        broadcasting = False
+
+        # Based on current opcode, execute specific action
+        if opcode == TX_OPCODE:
+            # Create transaction and broadcast if legal
+            start_time = metrics.start()
+            new_tx = Transaction(current_message)
+            metrics.observe("parse", start_time)
+            broadcasting, block = self.utxo.process_transaction(new_tx)
+        elif opcode == CLOSE_OPCODE:
+            self.close_status.value = 1  # Indicate close
+            self.utxo.cancel_mining()
+            broadcasting = True  # Forward close signal to peers
+            print("Broadcasting close message.")
+        elif opcode == BLOCK_OPCODE:
+            # Initialize received block
+            self.accept_block(current_message)
+        elif opcode == COMPACT_BLOCK_OPCODE:
+            # Rebuild block from pending transactions, reply with the gaps
+            reply = self.receive_compact_block(current_message)
+        elif opcode == BLOCK_TXS_OPCODE:
+            # Ask again for the whole block if its rebuilt root is wrong
+            reply = self.receive_block_txs(current_message)
+        elif opcode == GET_BLOCK_OPCODE:
+            # Pass specified block information to sender
+            reply = self.utxo.process_get_block(current_message)
+        elif opcode in (TX_BATCH_OPCODE, RELAY_BATCH_OPCODE):
+            # Validate whole batch, reply with one accept bit per transaction
+            batch_data = memoryview(current_message)[COUNT_STRUCT.size:]
+            flags, accepted, blocks = self.utxo.process_batch(batch_data)
+            if (opcode == TX_BATCH_OPCODE):  # Peers do not read the bits
+                reply = [encode_bitmap(flags)]
+            metrics.incr("batches")
+            if accepted:  # Forward only the accepted subset
+                self.broadcast_message(encode_frame(RELAY_BATCH_OPCODE,
+                                                   encode_batch(accepted)))
+            for mined_block in blocks:
+                self.relay_block(mined_block)
+        elif opcode == STATS_OPCODE:
+            reply = self.process_stats()
+        elif opcode == GET_TX_PROOF_OPCODE:
+            # Prove a transaction is part of a stored block
+            reply = self.utxo.process_get_tx_proof(current_message)
+        elif opcode == GET_TX_OPCODE:
+            # Look up a confirmed transaction by id
+            reply = self.utxo.process_get_tx(current_message)
+        elif opcode == GET_HEADERS_OPCODE:
+            reply = self.utxo.process_get_headers(current_message)
+        elif opcode == GET_BLOCKS_OPCODE:
+            # Stream a range of blocks straight from the block store
+            reply = self.utxo.process_get_blocks(current_message)
+
+        # Decide when to broadcast transactions and blocks
+        if broadcasting:
+            self.broadcast_message(encode_frame(opcode,
+                                                bytes(current_message)))
+        if block:
+            self.relay_block(block)
+            metrics.debug("Block broadcast to peer.")
+        return (reply)
 
     def connect_socket(self, client_socket, client_address):
         """Handle connections and incoming data."""
         start_time = time.time()  # Start recording time
-        self.create_peer_sockets()  # Connect peer sockets for broadcasting
-        message = self.process_data_bytes(client_socket)
-        while message:
-            print("Length of current message is:", len(message))
-            opcode = chr(int(message[0:1].hex(), 16))  # Get opcode
-            print ("Current opcode: ", opcode)
-
-            # Get specific message
-            msg_start = 1
-            msg_end = 1 + self.message_map.get(opcode)
-            current_message = message[msg_start: msg_end]
-            msg_with_opcode = message[0: msg_end]
-
-            # Based on current opcode, execute specific action
-            if opcode == TX_OPCODE:
-                # Create transaction and broadcast if legal
-                new_tx = Transaction(current_message)
-                broadcasting, block = self.utxo.process_transaction(new_tx)
-            elif opcode == CLOSE_OPCODE:
-                self.close_status.value = 1  # Indicate close
-                broadcasting = True  # Forward close signal to peers
-                block = False
-                print("Broadcasting close message.")
-                # self.stop()
-            elif opcode == BLOCK_OPCODE:
-                broadcasting = False
-                # Initialize received block
-                block = Block(self.difficulty, msg_with_opcode, self.numcores)
-                print("Block received: ", block)
-            elif opcode == GET_BLOCK_OPCODE:
-                # Pass specified block information to sender
-                block_at_height = self.utxo.process_get_block(current_message)
-                client_socket.send(block_at_height)
-
-            # Decide when to broadcast transactions and blocks
-            if broadcasting and block:
-                self.broadcast_message(msg_with_opcode)
-                self.broadcast_message(block.msg_bytearray)
-                print ("Block and transaction broadcast to peer.")
-            elif block:
-                self.broadcast_message(block.msg_bytearray)
-                print ("Block broadcast to peer.")
-            elif broadcasting:
-                self.broadcast_message(msg_with_opcode)
-
-            # Read in more data
+        bytes_in = "bytes_in.{}:{}".format(*client_address)
+        try:
             message = self.process_data_bytes(client_socket)
+            while message:
+                opcode, current_message = message
+                metrics.incr(bytes_in, 1 + len(current_message))
+                reply = self.handle_message(opcode, current_message)
+                if reply:
+                    self.send_reply(client_socket, reply)
 
-        # Message is completely read and node will close down
-        self.close_peer_sockets()  # Close peers after finishing
-        self.close()
+                # Read in more data
+                message = self.process_data_bytes(client_socket)
+        except ConnectionError:
+            pass  # Client went away mid message
+        except ValueError as error:
+            print("Bad message: ", error)  # Drop the client, not the node
+        finally:
+            # Client is done, its thread ends here
+            client_socket.close()
         end_time = time.time()  # Stop recording time
         work_time = end_time - start_time  # Compute duration of process
         print ("Time to run blockchain: ", work_time)
 
     def close(self):
-        """Close the node socket."""
+        """Save the ledger and close the node socket."""
+        with self.state_lock:
+            self.utxo.flush()
         self.socket.close()
@@ -0,0 +1,322 @@
+"""Spread account balances across worker processes.
+
+Each account belongs to the shard picked by the first byte of its id and
+only that shard's worker holds its balance. A batch of transactions is
+settled in two phases so no money is lost or spent twice:
+
+    Prepare: each shard checks and debits the senders it owns, holding
+        the amounts, and reports which of its receivers exist
+    Finish: the node rejects prepared transactions that are duplicates or
+        pay a missing account, the sender shards refund those holds and
+        the receiver shards credit the rest
+
+Shards cannot see credits or refunds from earlier in the batch. When a
+sender they turned down had one, the node refunds the holds and checks the
+batch again in order against the balances it touches, so the accepted
+transactions do not depend on the number of shards. Block transactions
+are held and credited the same way, all or nothing.
+
+Tasks:
+    Run one worker process per shard, each owning a Ledger
+    Route transactions to the shard of their sender
+    Merge prepared transactions from every shard back into batch order
+    Read and write the same snapshot files as an unsharded Ledger
+"""
+
+import heapq
+import multiprocessing as mp
+from array import array
+from hashlib import sha256
+
+from codec import TX_SIZE, TX_STRUCT
+from ledger import Ledger
+
+
+def shard_of(account, num_shards):
+    """Shard owning an account."""
+    return (account[0] % num_shards)
+
+
+class LedgerShard(Ledger):
+    """Balances of one shard, living in its worker process."""
+
+    def __init__(self):
+        """Initialize an empty shard."""
+        Ledger.__init__(self)
+        self.holds = {}  # Batch position to (balance index, held amount)
+
+    def adjust(self, deltas):
+        """Add (account, delta) pairs to balances."""
+        account_index = self.account_index
+        balances = self.balances
+        for account, delta in deltas:
+            balances[account_index[account]] += delta
+
+    def items(self):
+        """Return (account ids, balance bytes) of the shard."""
+        return (self.accounts, self.balances.tobytes())
+
+    def lookup(self, accounts):
+        """Balances of the accounts that exist, keyed by account id."""
+        account_index = self.account_index
+        balances = self.balances
+        return ({account: balances[account_index[account]]
+                 for account in accounts if account in account_index})
+
+    def prepare(self, positions, batch_data, receivers):
+        """Debit senders of a batch, return (prepared, missing receivers).
+
+        prepared holds (position, txid, amount) in batch order for every
+        transaction whose sender could pay.
+        """
+        account_index = self.account_index
+        balances = self.balances
+        self.holds = {}
+        seen = set()  # Copies of a transaction share its sender's shard
+        prepared = []
+        for i, fields in enumerate(TX_STRUCT.iter_unpack(batch_data)):
+            sender, _, amount, _ = fields
+            index = account_index.get(sender)
+            if index is None:
+                continue
+            txid = sha256(batch_data[i * TX_SIZE:(i + 1) * TX_SIZE]).digest()
+            amount = int(amount)  # Node checked the batch is digits
+            if (txid not in seen and 0 < amount < balances[index]):
+                balances[index] -= amount
+                self.holds[positions[i]] = (index, amount)
+                seen.add(txid)
+                prepared.append((positions[i], txid, amount))
+        missing = [receiver for receiver in receivers
+                   if receiver not in account_index]
+        return (prepared, missing)
+
+    def hold(self, debits, receivers):
+        """Debit (position, sender, amount) in order if every one can pay.
+
+        Nothing is held, and False returned, when a sender cannot pay or a
+        receiver does not exist.
+        """
+        account_index = self.account_index
+        balances = self.balances
+        self.holds = {}
+        if not all(receiver in account_index for receiver in receivers):
+            return (False)
+        for position, sender, amount in debits:
+            index = account_index.get(sender)
+            if index is None or not (0 < amount < balances[index]):
+                self.finish(list(self.holds), [])
+                return (False)
+            balances[index] -= amount
+            self.holds[position] = (index, amount)
+        return (True)
+
+    def finish(self, aborted, credits):
+        """Refund holds of aborted positions and apply (account, amount)."""
+        balances = self.balances
+        for position in aborted:
+            index, amount = self.holds[position]
+            balances[index] += amount
+        self.holds = {}
+        self.adjust(credits)
+
+
+def shard_worker(connection):
+    """Serve ledger calls for one shard until told to stop."""
+    shard = LedgerShard()
+    while True:
+        name, args = connection.recv()
+        if name is None:
+            break
+        connection.send(getattr(shard, name)(*args))
+    connection.close()
+
+
+class ShardedLedger(object):
+    """Ledger whose balances are split across shard worker processes."""
+
+    def __init__(self, num_shards):
+        """Start one worker per shard."""
+        self.num_shards = num_shards
+        self.connections = []
+        self.workers = []
+        for _ in range(num_shards):
+            connection, worker_connection = mp.Pipe()
+            worker = mp.Process(target=shard_worker,
+                                args=(worker_connection,), daemon=True)
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+        self.held = {}  # Batch position to shard holding its debit
+
+    def call(self, shard, name, *args):
+        """Run a ledger method on one shard."""
+        connection = self.connections[shard]
+        connection.send((name, args))
+        return (connection.recv())
+
+    def call_all(self, name, shard_args):
+        """Run a method on every shard at once, one argument tuple each."""
+        for connection, args in zip(self.connections, shard_args):
+            connection.send((name, args))
+        return ([connection.recv() for connection in self.connections])
+
+    def by_shard(self, pairs):
+        """Split (account, value) pairs into one list per shard."""
+        shard_pairs = [[] for _ in range(self.num_shards)]
+        for account, value in pairs:
+            shard_pairs[shard_of(account, self.num_shards)].append(
+                (account, value))
+        return (shard_pairs)
+
+    def __len__(self):
+        """Number of accounts."""
+        return (sum(self.call_all("__len__", [()] * self.num_shards)))
+
+    def __contains__(self, account):
+        """Check whether an account exists."""
+        return (self.call(shard_of(account, self.num_shards), "__contains__",
+                          bytes(account)))
+
+    def __getitem__(self, account):
+        """Balance of an account."""
+        return (self.call(shard_of(account, self.num_shards), "__getitem__",
+                          bytes(account)))
+
+    def __setitem__(self, account, balance):
+        """Set the balance of an account, creating it if needed."""
+        self.call(shard_of(account, self.num_shards), "__setitem__",
+                  bytes(account), balance)
+
+    def update(self, balances):
+        """Set the balances of several accounts."""
+        self.call_all("update", [(dict(pairs),) for pairs
+                                 in self.by_shard(balances.items())])
+
+    def apply_transfers(self, transfers):
+        """Debit senders and credit receivers for (sender, receiver, amount)."""
+        deltas = {}
+        for sender, receiver, amount in transfers:
+            deltas[sender] = deltas.get(sender, 0) - amount
+            deltas[receiver] = deltas.get(receiver, 0) + amount
+        self.call_all("adjust", [(pairs,) for pairs
+                                 in self.by_shard(deltas.items())])
+
+    def revert_transfers(self, transfers):
+        """Undo transfers applied with apply_transfers."""
+        self.apply_transfers((receiver, sender, amount)
+                             for sender, receiver, amount in transfers)
+
+    def lookup(self, accounts):
+        """Balances of the accounts that exist, keyed by account id."""
+        shard_accounts = [[] for _ in range(self.num_shards)]
+        for account in accounts:
+            shard_accounts[shard_of(account, self.num_shards)].append(
+                bytes(account))
+        balances = {}
+        for shard_balances in self.call_all("lookup", [
+                (shard_accounts[shard],) for shard in range(self.num_shards)]):
+            balances.update(shard_balances)
+        return (balances)
+
+    def try_transfers(self, transfers):
+        """Apply (sender, receiver, amount) in two phases if senders can pay.
+
+        Senders must pay from their balances before the transfers, so when
+        False is returned nothing was applied but the transfers may still
+        be valid in order.
+        """
+        num_shards = self.num_shards
+        debits = [[] for _ in range(num_shards)]
+        receivers = [set() for _ in range(num_shards)]
+        credits = {}
+        for position, (sender, receiver, amount) in enumerate(transfers):
+            debits[shard_of(sender, num_shards)].append(
+                (position, bytes(sender), amount))
+            receivers[shard_of(receiver, num_shards)].add(bytes(receiver))
+            credits[receiver] = credits.get(receiver, 0) + amount
+        held = self.call_all("hold", zip(debits, receivers))
+        if all(held):
+            self.call_all("finish", zip([[]] * num_shards,
+                                        self.by_shard(credits.items())))
+            return (True)
+        # Refund the shards that could pay their part
+        self.call_all("finish", [
+            ([position for position, _, _ in debits[shard]]
+             if held[shard] else [], []) for shard in range(num_shards)])
+        return (False)
+
+    def prepare_batch(self, batch_data):
+        """First phase of a batch, see LedgerShard.prepare.
+
+        Returns the prepared (position, txid, amount) of every shard merged
+        in batch order, and the set of receivers that do not exist.
+        """
+        num_shards = self.num_shards
+        positions = [array('I') for _ in range(num_shards)]
+        shard_data = [[] for _ in range(num_shards)]
+        receivers = [set() for _ in range(num_shards)]
+        for position in range(len(batch_data) // TX_SIZE):
+            start = position * TX_SIZE
+            shard = batch_data[start] % num_shards
+            positions[shard].append(position)
+            shard_data[shard].append(batch_data[start:start + TX_SIZE])
+            receiver = bytes(batch_data[start + 32:start + 64])
+            receivers[shard_of(receiver, num_shards)].add(receiver)
+        replies = self.call_all("prepare", [
+            (positions[shard], b''.join(shard_data[shard]),
+             receivers[shard]) for shard in range(num_shards)])
+        self.held = {}
+        missing = set()
+        for shard, (prepared, shard_missing) in enumerate(replies):
+            for position, _, _ in prepared:
+                self.held[position] = shard
+            missing.update(shard_missing)
+        return (list(heapq.merge(*[prepared for prepared, _ in replies])),
+                missing)
+
+    def finish_batch(self, aborted, transfers):
+        """Second phase, refund aborted positions and credit receivers.
+
+        transfers lists (receiver, amount) of the accepted transactions.
+        """
+        shard_aborted = [[] for _ in range(self.num_shards)]
+        for position in aborted:
+            shard_aborted[self.held[position]].append(position)
+        credits = {}
+        for receiver, amount in transfers:
+            credits[receiver] = credits.get(receiver, 0) + amount
+        self.call_all("finish", zip(shard_aborted,
+                                    self.by_shard(credits.items())))
+        self.held = {}
+
+    def merged(self):
+        """Unsharded copy of every balance, shard by shard."""
+        ledger = Ledger()
+        for accounts, balance_bytes in self.call_all(
+                "items", [()] * self.num_shards):
+            ledger.accounts.extend(accounts)
+            ledger.balances.frombytes(balance_bytes)
+        ledger.account_index = dict(zip(ledger.accounts,
+                                        range(len(ledger.accounts))))
+        return (ledger)
+
+    def snapshot(self, path, height):
+        """Write balances taken at block height to path atomically."""
+        self.merged().snapshot(path, height)
+
+    def restore(self, path):
+        """Load a snapshot, returning its block height or None if missing."""
+        ledger = Ledger()
+        height = ledger.restore(path)
+        if height is not None:
+            self.call_all("update", [(dict(pairs),) for pairs
+                                     in self.by_shard(zip(ledger.accounts,
+                                                          ledger.balances))])
+        return (height)
+
+    def close(self):
+        """Stop the shard workers."""
+        for connection in self.connections:
+            connection.send((None, ()))
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,192 @@
+"""Catch up with the chain of our peers, headers first.
+
+Headers are small, so they are fetched first from every peer and checked
+for linkage and proof of work before any block body is requested. Bodies
+are then fetched in ranges from every peer on the best header chain, with
+several requests in flight per connection, and applied in height order.
+
+Tasks:
+    Stream headers in ranges and check their links and proof of work
+    Fetch block ranges from several peers at once, pipelined
+    Hold only a bounded window of fetched blocks in memory
+    Hand a failed peer's ranges to the others
+"""
+
+import heapq
+import asyncio
+
+from block import Block
+from codec import (COUNT_STRUCT, HEADER_SIZE, LENGTH_STRUCT, RANGE_STRUCT,
+                   encode_frame)
+
+GET_HEADERS_OPCODE = "C"
+GET_BLOCKS_OPCODE = "D"
+HEADERS_PER_REQUEST = 2000  # Matches the most a node answers
+BLOCKS_PER_REQUEST = 16
+PIPELINE_DEPTH = 4  # Block range requests in flight on each connection
+MAX_AHEAD = 1024  # Blocks fetched beyond the next one to apply
+
+
+class ChainSyncer(object):
+    """Download and apply the blocks our peers have beyond our tip."""
+
+    def __init__(self, peers, validator, accept_block):
+        """Initialize syncer for validator's chain.
+
+        accept_block(message, block_hash) validates and stores one block.
+        """
+        self.peers = peers
+        self.validator = validator
+        self.accept_block = accept_block
+        self.hashes = []  # Header hashes of the blocks to fetch
+        self.start = 0  # Height of the first block to fetch
+        self.next_height = 0  # Next block to apply
+        self.ranges = []  # Heap of (height, count) still to be requested
+        self.fetched = {}  # Height to block bytes waiting to be applied
+        self.busy = 0  # Block ranges in flight across every peer
+        self.failed = False
+        self.advanced = None  # Condition notified as blocks get applied
+
+    async def run(self):
+        """Sync from every reachable peer, return the blocks applied."""
+        utxo = self.validator.utxo
+        self.start = self.next_height = len(utxo.block_store)
+        connections = []
+        for peer in self.peers:
+            try:
+                connections.append(await asyncio.open_connection(
+                    'localhost', int(peer)))
+            except OSError:
+                print("Peer not reachable for sync: ", peer)
+        peer_hashes = await asyncio.gather(*[
+            self.fetch_headers(reader, writer, utxo.tip_hash())
+            for reader, writer in connections])
+        self.hashes = max(peer_hashes, key=len, default=[])
+        end = self.start + len(self.hashes)
+        self.ranges = [(height, min(BLOCKS_PER_REQUEST, end - height))
+                       for height in range(self.start, end,
+                                           BLOCKS_PER_REQUEST)]
+        self.advanced = asyncio.Condition()
+        # Peers on the chain we picked serve it up to their last header
+        await asyncio.gather(*[
+            self.fetch_blocks(reader, writer, self.start + len(hashes))
+            for (reader, writer), hashes in zip(connections, peer_hashes)
+            if hashes and hashes == self.hashes[0:len(hashes)]])
+        for _, writer in connections:
+            writer.close()
+        return (self.next_height - self.start)
+
+    def check_headers(self, headers, height, prior_hash):
+        """Hashes of the headers that link to prior_hash and carry PoW."""
+        hashes = []
+        for offset in range(0, len(headers), HEADER_SIZE):
+            header = Block(self.validator.difficulty,
+                           headers[offset:offset + HEADER_SIZE], 0)
+            if (header.block_height != height + len(hashes)
+                    or header.prior_hash != prior_hash
+                    or not self.validator.check_proof_of_work(header)):
+                break
+            hashes.append(header.hash)
+            prior_hash = header.hash
+        return (hashes)
+
+    async def fetch_headers(self, reader, writer, prior_hash):
+        """Header hashes of a peer's chain beyond our tip."""
+        hashes = []
+        height = self.start
+        writer.write(encode_frame(GET_HEADERS_OPCODE, RANGE_STRUCT.pack(
+            height, HEADERS_PER_REQUEST)))
+        try:
+            while True:
+                count = COUNT_STRUCT.unpack(await reader.readexactly(
+                    COUNT_STRUCT.size))[0]
+                more = (count == HEADERS_PER_REQUEST)
+                if more:  # Ask for the next range while checking this one
+                    writer.write(encode_frame(GET_HEADERS_OPCODE,
+                                              RANGE_STRUCT.pack(height + count,
+                                                                count)))
+                headers = await reader.readexactly(count * HEADER_SIZE)
+                checked = self.check_headers(headers, height, prior_hash)
+                hashes.extend(checked)
+                if (more and len(checked) == count):
+                    height += count
+                    prior_hash = checked[-1]
+                    continue
+                if more:  # Invalid header, drop the reply already asked for
+                    count = COUNT_STRUCT.unpack(await reader.readexactly(
+                        COUNT_STRUCT.size))[0]
+                    await reader.readexactly(count * HEADER_SIZE)
+                break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # Keep the headers checked so far
+        return (hashes)
+
+    async def read_blocks(self, reader):
+        """Read one block range reply."""
+        count = COUNT_STRUCT.unpack(await reader.readexactly(
+            COUNT_STRUCT.size))[0]
+        lengths = await reader.readexactly(count * LENGTH_STRUCT.size)
+        return ([await reader.readexactly(length) for length,
+                 in LENGTH_STRUCT.iter_unpack(lengths)])
+
+    async def requeue(self, ranges):
+        """Hand ranges back so another peer can fetch them."""
+        for block_range in ranges:
+            heapq.heappush(self.ranges, block_range)
+        async with self.advanced:
+            self.advanced.notify_all()
+
+    async def fetch_blocks(self, reader, writer, end):
+        """Keep several ranges of blocks below end in flight on a peer."""
+        in_flight = []
+        while not self.failed:
+            while (self.ranges and len(in_flight) < PIPELINE_DEPTH
+                   and self.ranges[0][0] < min(end, self.next_height
+                                               + MAX_AHEAD)):
+                height, count = heapq.heappop(self.ranges)
+                if (height + count > end):  # Past the headers peer sent
+                    heapq.heappush(self.ranges, (end, height + count - end))
+                    count = end - height
+                writer.write(encode_frame(GET_BLOCKS_OPCODE,
+                                          RANGE_STRUCT.pack(height, count)))
+                in_flight.append((height, count))
+                self.busy += 1
+            if not in_flight:
+                servable = self.ranges and self.ranges[0][0] < end
+                if not servable and not self.busy:
+                    break  # Nothing left that this peer can serve
+                async with self.advanced:  # Wait for the window to move
+                    await self.advanced.wait()
+                continue
+            height, count = in_flight.pop(0)
+            try:
+                await writer.drain()
+                blocks = await self.read_blocks(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.busy -= 1 + len(in_flight)
+                await self.requeue([(height, count)] + in_flight)
+                return
+            self.busy -= 1
+            for i, message in enumerate(blocks):
+                self.fetched[height + i] = message
+            if (len(blocks) < count):  # Peer does not have the rest
+                self.busy -= len(in_flight)
+                await self.requeue([(height + len(blocks),
+                                     count - len(blocks))] + in_flight)
+                await self.apply_fetched()
+                return
+            await self.apply_fetched()
+
+    async def apply_fetched(self):
+        """Apply fetched blocks that continue our chain."""
+        while not self.failed and self.next_height in self.fetched:
+            message = self.fetched.pop(self.next_height)
+            if not self.accept_block(message, self.hashes[self.next_height
+                                                          - self.start]):
+                print("Sync stopped: invalid block at height ",
+                      self.next_height)
+                self.failed = True
+                break
+            self.next_height += 1
+        async with self.advanced:  # Let waiting peers look again
+            self.advanced.notify_all()
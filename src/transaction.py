@@ -8,6 +8,8 @@ Parse the transactions:
 
 import hashlib
 
+from codec import decode_transaction
+
 
 class Transaction(object):
     """Handle blockchain transactions."""
@@ -18,40 +20,21 @@ class Transaction(object):
         transaction_data = self.parse_transaction(message_data)
         (self.sender, self.receiver, self.amount,
          self.timestamp) = transaction_data
-
-    def convert_tx_data(self, hex_input):
-        """Convert amount and timestamp attributes to integers."""
-        num = ""
-        for i in range(len(hex_input) // 2):
-            num += chr(int(hex_input[2*i:(2*i)+2], 16))
-        return (int(num))
+        self.txid = None  # Transaction id, computed on first use
 
     def compute_transaction_hash(self):
-        """Compute hash of current block."""
-        # Obtain attributes of transaction class to sum hash values
-        sender_bytes = bytes(self.sender, "ascii")
-        receiver_bytes = bytes(self.receiver, "ascii")
-        amount_bytes = bytes(self.amount, "ascii")
-        timestamp_bytes = bytes(self.timestamp, "ascii")
-        computed_sum_bytes = (sender_bytes + receiver_bytes + amount_bytes
-                              + timestamp_bytes)
-        computed_hash = hashlib.sha256(computed_sum_bytes).hexdigest()
-        return (computed_hash)
+        """Compute the transaction id from the original bytes."""
+        if self.txid is None:
+            self.txid = hashlib.sha256(self.msg_bytearray).digest()
+        return (self.txid)
 
     def parse_transaction(self, byte_message):
         """Parse the byte array of transactions."""
-        hex_message = byte_message.hex()
-        sender = hex_message[0:64]
-        receiver = hex_message[64:128]
-        amount = self.convert_tx_data(hex_message[128:192])
-        timestamp = self.convert_tx_data(hex_message[192:256])
-        # amount = int(hex_message[128:192], 16)
-        # timestamp = int(hex_message[192:256], 16)
-
-        return (sender, receiver, amount, timestamp)
+        return (decode_transaction(byte_message))
 
     def __str__(self):
         """Pretty printing of transaction for debugging purposes."""
         # DELETE THIS DELETE DELETE DELETE
         return ("\nSender: {} -- Receiver: {} -- Amount: {} -- Timestamp: {}\n".format(
-            self.sender, self.receiver, self.amount, self.timestamp))
+            self.sender.hex(), self.receiver.hex(), self.amount,
+            self.timestamp))
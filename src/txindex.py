@@ -0,0 +1,165 @@
+"""Record where every confirmed transaction is stored on the chain.
+
+Tasks:
+    Map transaction id to (block height, position in block) on disk
+    Keep a Bloom filter in memory so most lookups never touch the table
+    Grow the table as the chain grows while keeping lookups O(1)
+    Replace the table only once its larger copy is complete
+"""
+
+import os
+import mmap
+import struct
+
+# Number of stored transactions, ahead of the slots
+HEADER_STRUCT = struct.Struct('<Q')
+# Transaction id, block height and position of the transaction in the block
+SLOT_STRUCT = struct.Struct('<32sII')
+EMPTY_TXID = bytes(32)
+MIN_SLOTS = 1 << 16
+BITS_PER_ITEM = 10  # About one percent false positives
+NUM_HASHES = 7
+
+
+class BloomFilter(object):
+    """Set membership test with false positives but no false negatives."""
+
+    def __init__(self, capacity):
+        """Size filter to hold capacity transaction ids."""
+        self.num_bits = max(8, capacity * BITS_PER_ITEM)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def positions(self, txid):
+        """Bit positions for a transaction id."""
+        # Transaction ids are sha256 digests, so their bytes are uniform
+        return ([int.from_bytes(txid[4*i:4*i + 4], 'little') % self.num_bits
+                 for i in range(NUM_HASHES)])
+
+    def add(self, txid):
+        """Set the bits of a transaction id."""
+        for position in self.positions(txid):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, txid):
+        """Check whether a transaction id may have been added."""
+        bits = self.bits
+        for position in self.positions(txid):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return (False)
+        return (True)
+
+
+class TxIndex(object):
+    """Open addressing hash table of transaction ids in a mapped file."""
+
+    def __init__(self, datadir):
+        """Open or create the index files in datadir."""
+        self.path = os.path.join(datadir, "txindex.tbl")
+        self.bloom_path = os.path.join(datadir, "txindex.bloom")
+        if not os.path.exists(self.path):
+            self.create_table(self.path, MIN_SLOTS)
+        self.open_table(self.path)
+        self.bloom = self.load_bloom()
+
+    def create_table(self, path, num_slots):
+        """Write an empty table with num_slots slots."""
+        with open(path, "wb") as table_file:
+            table_file.truncate(HEADER_STRUCT.size
+                                + SLOT_STRUCT.size * num_slots)
+
+    def open_table(self, path):
+        """Map the table file and read its entry count."""
+        self.table_file = open(path, "r+b")
+        self.table = mmap.mmap(self.table_file.fileno(), 0)
+        self.num_slots = ((len(self.table) - HEADER_STRUCT.size)
+                          // SLOT_STRUCT.size)
+        self.count = HEADER_STRUCT.unpack_from(self.table)[0]
+
+    def entries(self):
+        """Yield (txid, height, position) for every stored transaction."""
+        slots = self.table[HEADER_STRUCT.size:]
+        for txid, height, position in SLOT_STRUCT.iter_unpack(slots):
+            if (txid != EMPTY_TXID):
+                yield (txid, height, position)
+
+    def load_bloom(self):
+        """Load the saved Bloom filter, or rebuild it from the table."""
+        bloom = BloomFilter(self.num_slots // 2)
+        if os.path.exists(self.bloom_path):
+            with open(self.bloom_path, "rb") as bloom_file:
+                saved = bloom_file.read()
+            if (len(saved) == len(bloom.bits)):
+                bloom.bits[:] = saved
+                return (bloom)
+        for txid, _, _ in self.entries():
+            bloom.add(txid)
+        return (bloom)
+
+    def save(self):
+        """Flush the table and save the Bloom filter."""
+        self.table.flush()
+        with open(self.bloom_path + ".tmp", "wb") as bloom_file:
+            bloom_file.write(self.bloom.bits)
+        os.replace(self.bloom_path + ".tmp", self.bloom_path)
+
+    def slot(self, txid):
+        """Slot holding txid, or the empty slot where it would go."""
+        mask = self.num_slots - 1
+        index = int.from_bytes(txid[0:8], 'little') & mask
+        while True:
+            offset = HEADER_STRUCT.size + index * SLOT_STRUCT.size
+            slot_txid = self.table[offset:offset + 32]
+            if slot_txid == txid or slot_txid == EMPTY_TXID:
+                return (offset)
+            index = (index + 1) & mask
+
+    def __contains__(self, txid):
+        """Check whether a transaction has been confirmed."""
+        if txid not in self.bloom:
+            return (False)  # Most fresh transactions stop here
+        return (self.lookup(txid) is not None)
+
+    def lookup(self, txid):
+        """Return (height, position) of a confirmed transaction or None."""
+        slot_txid, height, position = SLOT_STRUCT.unpack_from(
+            self.table, self.slot(txid))
+        if (slot_txid == EMPTY_TXID):
+            return (None)
+        return (height, position)
+
+    def add(self, txid, height, position):
+        """Record a confirmed transaction."""
+        if ((self.count + 1) * 2 > self.num_slots):
+            self.grow()
+        offset = self.slot(txid)
+        if (self.table[offset:offset + 32] == EMPTY_TXID):
+            self.count += 1
+            HEADER_STRUCT.pack_into(self.table, 0, self.count)
+        SLOT_STRUCT.pack_into(self.table, offset, txid, height, position)
+        self.bloom.add(txid)
+
+    def grow(self):
+        """Double the table and Bloom filter, keeping the load under half.
+
+        The larger table is filled in a temporary file that then replaces
+        the table, so stopping part way leaves the old table whole.
+        """
+        entries = list(self.entries())
+        self.close()
+        temp_path = self.path + ".tmp"
+        self.create_table(temp_path, self.num_slots * 2)
+        self.open_table(temp_path)
+        self.bloom = BloomFilter(self.num_slots // 2)
+        for txid, height, position in entries:
+            SLOT_STRUCT.pack_into(self.table, self.slot(txid), txid, height,
+                                  position)
+            self.bloom.add(txid)
+        self.count = len(entries)
+        HEADER_STRUCT.pack_into(self.table, 0, self.count)
+        self.table.flush()
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        """Close the table file."""
+        self.table.close()
+        self.table_file.close()
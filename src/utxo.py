@@ -6,37 +6,124 @@ Tasks:
     Broadcast all transactions to peers
 """
 
+import os
 from hashlib import sha256
+from itertools import islice
 from block import Block
+from blockstore import BlockStore, FileRange
+from codec import (COUNT_STRUCT, HEADER_SIZE, LENGTH_STRUCT, RANGE_STRUCT,
+                   TX_SIZE, TX_STRUCT, check_digits,
+                   decode_block_txs_request, encode_block_txs,
+                   encode_compact_block, encode_header, iter_transactions)
+from compact import PartialBlock, short_id_index
+from ledger import Ledger
+from merkle import (IncrementalMerkleTree, encode_proof, merkle_proof,
+                    merkle_root)
+from metrics import metrics
+from mempool import Mempool, transaction_id
+from shards import ShardedLedger
+from txindex import TxIndex
+
+MEMPOOL_BLOCKS = 4  # Blocks worth of pending transactions to hold
+MAX_HEADERS = 2000  # Most headers answered per range request
+MAX_BLOCKS = 64  # Most blocks answered per range request
+SNAPSHOT_INTERVAL = 100  # Blocks between saves, replay covers the rest
 
 
 class UTXO(object):
     """Handle blockchain transactions."""
 
-    def __init__(self, numtxinblock, difficulty, numcores):
+    def __init__(self, numtxinblock, difficulty, numcores, mining_pool=None,
+                 datadir=None, max_block_wait=None, num_shards=1):
         """Initialize the UTXO set to work as a ledger."""
-        self.utxo = self.create_utxo()
-        self.numtxinblock = numtxinblock
+        self.numtxinblock = numtxinblock  # Most transactions in a block
+        # Seconds a pending transaction may wait before a partial block is
+        # sealed, None to only seal full blocks
+        self.max_block_wait = max_block_wait
+        self.num_shards = num_shards  # Worker processes holding balances
         self.difficulty = difficulty
         self.numcores = numcores
-        self.transaction_list = []  # List of transaction byte array data
-        self.block_list = []  # List of block data
+        self.mining_pool = mining_pool  # Shared workers for mining blocks
+        # Pending transactions waiting to be mined
+        self.mempool = Mempool(numtxinblock * MEMPOOL_BLOCKS)
+        # Merkle tree over the transactions of the next block
+        self.pending_tree = IncrementalMerkleTree()
+        self.background_miner = None  # Mines blocks off the ingest path
+        self.candidate = None  # Block being mined in the background
+        self.reserved = 0  # Leading mempool transactions in the candidate
+        self.block_store = BlockStore(datadir)  # Blocks kept on disk
+        # Where each confirmed transaction is stored
+        self.tx_index = TxIndex(self.block_store.datadir)
+        self.utxo = self.create_utxo()
 
     def create_utxo(self):
-        """Define and initalize UTXO set."""
-        utxo_set = {}
-        for i in range(100):
-            account = sha256(bytes(str(i), 'ascii')).hexdigest()
-            utxo_set[account] = 100000
+        """Define and initalize UTXO set, resuming from a snapshot if any."""
+        if (self.num_shards > 1):
+            utxo_set = ShardedLedger(self.num_shards)
+        else:
+            utxo_set = Ledger()
+        height = utxo_set.restore(self.snapshot_path())
+        if height is None:
+            for i in range(100):
+                account = sha256(bytes(str(i), 'ascii')).digest()
+                utxo_set[account] = 100000
+            height = 0
+        if (height > len(self.block_store)):
+            raise RuntimeError("Ledger snapshot is from block {} but only {} "
+                               "blocks are stored".format(
+                                   height, len(self.block_store)))
+        self.replay_blocks(utxo_set, height)
         return (utxo_set)
 
+    def replay_blocks(self, utxo_set, start):
+        """Apply stored blocks from height start on to utxo_set.
+
+        The snapshot falls behind the block store by up to
+        SNAPSHOT_INTERVAL blocks when the node stops without a flush.
+        """
+        if (start == len(self.block_store)):
+            return
+        print("Replaying blocks from: ", start)
+        for height in range(start, len(self.block_store)):
+            block_data = self.block_store.read(height)[HEADER_SIZE:]
+            utxo_set.apply_transfers([(sender, receiver, amount)
+                                      for sender, receiver, amount, _
+                                      in iter_transactions(block_data)])
+            for position in range(len(block_data) // TX_SIZE):
+                offset = position * TX_SIZE
+                self.tx_index.add(transaction_id(block_data[offset:offset
+                                                            + TX_SIZE]),
+                                  height, position)
+        self.tx_index.save()
+        utxo_set.snapshot(self.snapshot_path(), len(self.block_store))
+
+    def snapshot_path(self):
+        """File holding the ledger snapshot next to the block store."""
+        return (os.path.join(self.block_store.datadir, "ledger.snap"))
+
+    def save_snapshot(self):
+        """Snapshot balances as of the last stored block."""
+        # Pending transactions are already applied but not yet in a block
+        pending_data = b''.join(self.mempool.transactions.values())
+        pending = [(sender, receiver, amount) for sender, receiver, amount, _
+                   in iter_transactions(pending_data)]
+        self.utxo.revert_transfers(pending)
+        self.utxo.snapshot(self.snapshot_path(), len(self.block_store))
+        self.utxo.apply_transfers(pending)
+
+    def flush(self):
+        """Save the transaction index and ledger as of the last block."""
+        self.tx_index.save()
+        self.save_snapshot()
+
     def check_balances(self, transaction):
-        """Check for double spending transactions."""
-        return (self.utxo[transaction.sender] > transaction.amount)
+        """Check the sender can pay a positive amount."""
+        return (0 < transaction.amount < self.utxo[transaction.sender])
 
     def check_double_spending(self, transaction):
         """Check for double spending transactions."""
-        return (transaction.msg_bytearray in self.transaction_list)
+        txid = transaction.compute_transaction_hash()
+        return (txid in self.mempool or txid in self.tx_index)
 
     def check_sender_receiver(self, transaction):
         """Check for double spending transactions."""
@@ -44,72 +131,319 @@ class UTXO(object):
                 and transaction.receiver in self.utxo)
 
     def store_transaction(self, transaction):
-        """Store processed transactions in list."""
-        self.transaction_list.append(transaction.msg_bytearray)
-        print ("Transaction processed: ", transaction)
+        """Store processed transactions in the mempool."""
+        self.add_to_mempool(transaction.compute_transaction_hash(),
+                            transaction.msg_bytearray)
+        metrics.debug("Transaction processed: ", transaction)
+
+    def add_to_mempool(self, txid, tx_bytes):
+        """Add a transaction and extend the next block's tree."""
+        self.mempool.add(txid, tx_bytes)
+        if (len(self.pending_tree) < self.numtxinblock):
+            self.pending_tree.append(txid)
+
+    def rebuild_pending_tree(self):
+        """Rebuild the next block's Merkle tree from the mempool."""
+        self.pending_tree = IncrementalMerkleTree(
+            islice(self.mempool.transactions, self.reserved,
+                   self.reserved + self.numtxinblock))
 
     def process_transaction(self, transaction):
         """Maintain transaction history and account balances."""
         sender = transaction.sender
         receiver = transaction.receiver
         amount = transaction.amount
-
-        # Obtain balances
-        sender_balance = self.utxo[sender]
-        receiver_balance = self.utxo[receiver]
-
-        # Add money to receiver account/remove money from sender account
-        new_sendbalance = sender_balance - amount
-        new_recvbalance = receiver_balance + amount
+        start_time = metrics.start()
 
         # Check for double spending before processing transaction
-        if (not self.check_double_spending(transaction)
+        if (self.mempool.room() > 0
+                and not self.check_double_spending(transaction)
                 and self.check_sender_receiver(transaction)
                 and self.check_balances(transaction)):
-            # Update balances if sender has enough money
-            # if (sender_balance > amount):
-            self.utxo[receiver] = new_sendbalance
-            self.utxo[sender] = new_recvbalance
+            # Add money to receiver account/remove money from sender account
+            self.utxo[sender] -= amount
+            self.utxo[receiver] += amount
             self.store_transaction(transaction)  # Note transaction
+            metrics.observe("validate", start_time)
+            metrics.incr("tx_accepted")
             # Initiate mining process
-            if (len(self.transaction_list) == self.numtxinblock):
+            if self.background_miner is not None:
+                self.start_mining()
+            elif self.seal_due():
                 mined_block = self.mine()
                 self.process_block(mined_block)  # Store block
                 return (True, mined_block)  # Broadcast mined block
             return (True, None)  # Ensure transaction gets broadcast
         else:
-            print ("Transaction not processed: double spending")
+            metrics.observe("validate", start_time)
+            metrics.incr("tx_rejected")
+            metrics.debug("Transaction not processed: ", transaction)
             return (False, None)  # Do not broadcast bad transactions
 
+    def process_batch(self, batch_data):
+        """Validate a batch of transactions in order against the ledger.
+
+        Returns the accept flag of each transaction, the accepted
+        transaction messages and any blocks mined along the way.
+        """
+        start_time = metrics.start()
+        check_digits(batch_data)  # Malformed batches are refused whole
+        if (self.num_shards > 1):
+            flags, accepted = self.validate_batch_sharded(batch_data)
+        else:
+            flags, accepted = self.validate_batch(batch_data)
+        for txid, tx_bytes, _, _, _ in accepted:
+            self.add_to_mempool(txid, tx_bytes)
+        metrics.observe("validate_batch", start_time)
+        metrics.incr("tx_accepted", len(accepted))
+        metrics.incr("tx_rejected", len(flags) - len(accepted))
+        mined_blocks = []
+        if self.background_miner is not None:
+            self.start_mining()
+        while (self.background_miner is None and self.seal_due()):
+            mined_block = self.mine()
+            self.process_block(mined_block)
+            mined_blocks.append(mined_block)
+        return (flags, [tx_bytes for _, tx_bytes, _, _, _ in accepted],
+                mined_blocks)
+
+    def validate_batch(self, batch_data):
+        """Check and apply a batch, return its flags and accepted entries.
+
+        Accepted entries are (txid, tx_bytes, sender, receiver, amount).
+        """
+        flags, accepted = self.check_batch(batch_data, self.utxo)
+        self.utxo.apply_transfers([(sender, receiver, amount) for _, _, sender,
+                                   receiver, amount in accepted])
+        return (flags, accepted)
+
+    def check_batch(self, batch_data, utxo):
+        """Check a batch in order against utxo balances without applying it."""
+        balances = {}  # Balances changed by earlier transactions in batch
+        seen = set()  # Transaction ids already in this batch
+        flags = []
+        accepted = []
+        mempool = self.mempool
+        tx_index = self.tx_index
+        room = mempool.room()  # Transactions past this are refused
+        for i, fields in enumerate(TX_STRUCT.iter_unpack(batch_data)):
+            sender, receiver, amount, _ = fields
+            tx_bytes = batch_data[i * TX_SIZE:(i + 1) * TX_SIZE]
+            txid = transaction_id(tx_bytes)
+            valid = (len(accepted) < room
+                     and txid not in seen and txid not in mempool
+                     and sender in utxo and receiver in utxo
+                     and txid not in tx_index)
+            if valid:
+                amount = int(amount)
+                sender_balance = balances.get(sender, utxo[sender])
+                valid = (0 < amount < sender_balance)
+            if valid:
+                balances[sender] = sender_balance - amount
+                balances[receiver] = (balances.get(receiver, utxo[receiver])
+                                      + amount)
+                seen.add(txid)
+                accepted.append((txid, tx_bytes, sender, receiver, amount))
+            flags.append(valid)
+        return (flags, accepted)
+
+    def validate_batch_sharded(self, batch_data):
+        """Settle a batch on the ledger shards in two phases.
+
+        Shards debit the senders first, then transactions that are already
+        known or pay a missing account are refunded and the rest credited.
+        A sender the shards turned down may have been paid or refunded
+        earlier in the batch, then the batch is checked again in order.
+        """
+        prepared, missing = self.utxo.prepare_batch(batch_data)
+        prepared = {position: (txid, amount)
+                    for position, txid, amount in prepared}
+        flags = [False] * (len(batch_data) // TX_SIZE)
+        accepted = []
+        aborted = []
+        credited = set()  # Accounts paid or refunded earlier in the batch
+        room = self.mempool.room()
+        for position in range(len(flags)):
+            tx_bytes = batch_data[position * TX_SIZE:(position + 1) * TX_SIZE]
+            sender = bytes(tx_bytes[0:32])
+            if position not in prepared:
+                if (sender in credited and len(accepted) < room):
+                    return (self.revalidate_batch(batch_data, list(prepared)))
+                continue
+            txid, amount = prepared[position]
+            receiver = bytes(tx_bytes[32:64])
+            if (len(accepted) >= room
+                    or txid in self.mempool or receiver in missing
+                    or txid in self.tx_index):
+                aborted.append(position)
+                credited.add(sender)
+                continue
+            flags[position] = True
+            credited.add(receiver)
+            accepted.append((txid, tx_bytes, sender, receiver, amount))
+        self.utxo.finish_batch(aborted, [(receiver, amount) for _, _, _,
+                                         receiver, amount in accepted])
+        return (flags, accepted)
+
+    def revalidate_batch(self, batch_data, held):
+        """Refund the held positions and check the batch in order."""
+        self.utxo.finish_batch(held, [])
+        accounts = set()
+        for start in range(0, len(batch_data), TX_SIZE):
+            accounts.add(bytes(batch_data[start:start + 32]))
+            accounts.add(bytes(batch_data[start + 32:start + 64]))
+        flags, accepted = self.check_batch(batch_data,
+                                           self.utxo.lookup(accounts))
+        self.utxo.apply_transfers([(sender, receiver, amount) for _, _, sender,
+                                   receiver, amount in accepted])
+        return (flags, accepted)
+
     def padding(self, input_byte, byte_length):
         """Pad nonce to ensure byte length of 32."""
         pad_amount = byte_length - len(input_byte)
         input_byte += (b'0' * pad_amount)  # Pad to get desired byte length
         return (input_byte)
 
+    def seal_due(self):
+        """Check whether pending transactions should be sealed in a block."""
+        if (len(self.mempool) >= self.numtxinblock):
+            return (True)  # Full block
+        oldest = self.mempool.oldest_arrival()
+        if (self.max_block_wait is None or oldest is None):
+            return (False)
+        return (self.mempool.clock() - oldest >= self.max_block_wait)
+
+    def seal_deadline(self):
+        """Mempool clock time a partial block is due, None if nothing waits."""
+        oldest = self.mempool.oldest_arrival()
+        if (self.max_block_wait is None or oldest is None):
+            return (None)
+        return (oldest + self.max_block_wait)
+
     def mine(self):
         """Create a new block through mining."""
+        transactions = self.mempool.pop_oldest(self.numtxinblock)
+        new_block = self.create_block(transactions)
+        self.rebuild_pending_tree()  # Start tree for the following block
+        start_time = metrics.start()
+        new_block.mine_blocks(self.mining_pool)  # Mine block
+        metrics.observe("mine", start_time)
+        metrics.incr("blocks_mined")
+        return (new_block)
+
+    def create_block(self, transactions):
+        """Build an unmined block over the oldest pending transactions."""
+        prior_hash = self.tip_hash()
+        miner_address = int.from_bytes(self.padding(bytes("cto9", "ascii"),
+                                                    32), 'big')
+        if (len(self.pending_tree) == len(transactions)):
+            block_root = self.pending_tree.root()
+        else:
+            block_root = merkle_root([transaction_id(tx_bytes)
+                                      for tx_bytes in transactions])
+        header = encode_header(0, prior_hash, bytes(32),
+                               len(self.block_store), miner_address,
+                               block_root)
+        block_data = b''.join(transactions)
+        return (Block(self.difficulty, header + block_data, self.numcores))
+
+    def start_mining(self):
+        """Hand the next block to the background miner once it is due."""
+        if (self.background_miner is None or self.candidate is not None
+                or not self.seal_due()):
+            return (False)
+        transactions = list(islice(self.mempool.transactions.values(),
+                                   self.numtxinblock))
+        self.candidate = self.create_block(transactions)
+        self.reserved = len(transactions)  # Keep them until block is stored
+        self.rebuild_pending_tree()  # Start tree for the following block
+        self.background_miner.start(self.candidate)
+        return (True)
+
+    def cancel_mining(self):
+        """Abandon the block being mined, its transactions stay pending."""
+        if self.candidate is None:
+            return
+        self.background_miner.cancel()
+        self.candidate = None
+        self.reserved = 0
+        self.rebuild_pending_tree()
+
+    def commit_mined_block(self, block):
+        """Store a block mined in the background, False if it is stale."""
+        if block is not self.candidate:
+            return (False)  # Mining was cancelled in the meantime
+        txids = list(islice(self.mempool.transactions, self.reserved))
+        self.candidate = None
+        self.reserved = 0
+        self.mempool.remove(txids)
+        self.rebuild_pending_tree()
+        metrics.incr("blocks_mined")
+        self.process_block(block)
+        return (True)
+
+    def tip_hash(self):
+        """Hash the next block must link to."""
         # Check whether genesis block needs to be created or not
-        if (len(self.block_list) == 0):  # genesis block is already in list
+        prior_hash = self.block_store.tip_hash()
+        if prior_hash is None:
             prior_hash = sha256(bytes("0", 'ascii')).digest()  # Genesis block
-        else:
-            prior_hash = bytes.fromhex(self.block_list[len(self.block_list) - 1].hash)
-        nonce = self.padding(bytes("1", "ascii"), 32)
-        block_hash = self.padding(bytes([0]), 32)
-        block_height = self.padding(bytes(str(len(self.block_list)),
-                                          "ascii"), 32)
-        miner_address = self.padding(bytes("cto9", "ascii"), 32)
-        block_data = b''.join(self.transaction_list)
-        message_data = (nonce + prior_hash + block_hash + block_height
-                        + miner_address + block_data)
-        new_block = Block(self.difficulty, message_data, self.numcores)
-        new_block.mine_blocks()  # Mine block
-        self.transaction_list = []  # Empty transaction list
-        return (new_block)
+        return (prior_hash)
+
+    def apply_block_transactions(self, transactions):
+        """Apply (txid, sender, receiver, amount) in order, all or nothing.
+
+        Transactions already in the mempool were applied when received and
+        are only removed from it.
+        """
+        mempool = self.mempool
+        seen = set()
+        transfers = []  # Transactions not yet applied
+        for txid, sender, receiver, amount in transactions:
+            if txid in seen or txid in self.tx_index:
+                return (False)
+            seen.add(txid)
+            if txid not in mempool:
+                transfers.append((sender, receiver, amount))
+        if not self.apply_in_order(transfers):
+            return (False)
+        # Block is valid, so ours at this height can no longer be stored
+        self.cancel_mining()
+        mempool.remove(seen)
+        self.rebuild_pending_tree()
+        return (True)
+
+    def apply_in_order(self, transfers):
+        """Apply (sender, receiver, amount) if each can be paid in turn."""
+        utxo = self.utxo
+        if (self.num_shards > 1):
+            if utxo.try_transfers(transfers):
+                return (True)  # Every sender could pay up front
+            # Senders may be paid earlier in the same transfers
+            utxo = utxo.lookup([account for sender, receiver, _ in transfers
+                                for account in (sender, receiver)])
+        balances = {}  # Balances changed by earlier transfers
+        for sender, receiver, amount in transfers:
+            if not (sender in utxo and receiver in utxo):
+                return (False)
+            sender_balance = balances.get(sender, utxo[sender])
+            if not (0 < amount < sender_balance):
+                return (False)
+            balances[sender] = sender_balance - amount
+            balances[receiver] = balances.get(receiver, utxo[receiver]) + amount
+        self.utxo.apply_transfers(transfers)
+        return (True)
 
     def store_block(self, block):
-        """Store processed blocks in list."""
-        self.block_list.append(block)
+        """Append processed blocks to the block store."""
+        height = self.block_store.append(block.msg_bytearray, block.hash)
+        block_data = block.block_data
+        for position in range(len(block_data) // TX_SIZE):
+            start = position * TX_SIZE
+            self.tx_index.add(transaction_id(block_data[start:start + TX_SIZE]),
+                              height, position)
+        if (len(self.block_store) % SNAPSHOT_INTERVAL == 0):
+            self.flush()
 
     def process_block(self, block):
         """Maintain block history."""
@@ -117,7 +451,83 @@ class UTXO(object):
         print ("Block processed: ", block)
         return (True)  # Ensure that block gets broadcast to peers
 
+    def compact_block(self, block):
+        """Header and short transaction ids of a block, for relaying."""
+        block_data = block.block_data
+        txids = [transaction_id(block_data[i:i + TX_SIZE])
+                 for i in range(0, len(block_data), TX_SIZE)]
+        return (encode_compact_block(block.msg_bytearray[0:HEADER_SIZE],
+                                     txids))
+
+    def rebuild_compact_block(self, message):
+        """Fill a compact block from pending transactions."""
+        index = short_id_index(self.mempool.transactions.items())
+        return (PartialBlock(message, index))
+
+    def process_get_block_txs(self, message):
+        """Transactions of a stored block that a peer could not rebuild."""
+        height, block_hash, positions = decode_block_txs_request(message)
+        if (height >= len(self.block_store)
+                or self.block_store.entry(height)[2] != block_hash):
+            return (encode_block_txs(block_hash, []))  # Block is not ours
+        block_data = self.block_store.read(height)[HEADER_SIZE:]
+        count = len(block_data) // TX_SIZE
+        transactions = [block_data[i * TX_SIZE:(i + 1) * TX_SIZE]
+                        for i in positions if i < count]
+        return (encode_block_txs(block_hash, transactions))
+
     def process_get_block(self, block_height):
-        """Retrieve block at specified height."""
-        if block_height <= len(self.block_list):
-            return (self.block_list[block_height-1])
+        """Locate block at specified height, as a list of reply parts."""
+        height = int.from_bytes(block_height, 'big')
+        if (height >= len(self.block_store)):
+            return ([LENGTH_STRUCT.pack(0)])  # No block at this height
+        file_range = self.block_store.file_range(height)
+        return ([LENGTH_STRUCT.pack(file_range.count), file_range])
+
+    def stored_range(self, message, limit):
+        """Return (start, count) of a range request clipped to the chain."""
+        start, count = RANGE_STRUCT.unpack_from(message)
+        return (start, max(0, min(count, limit,
+                                  len(self.block_store) - start)))
+
+    def process_get_headers(self, message):
+        """Headers of a range of stored blocks as reply parts."""
+        start, count = self.stored_range(message, MAX_HEADERS)
+        headers = b''.join(self.block_store.read_header(height, HEADER_SIZE)
+                           for height in range(start, start + count))
+        return ([COUNT_STRUCT.pack(count), headers])
+
+    def process_get_blocks(self, message):
+        """Lengths of a range of stored blocks, then the blocks themselves."""
+        start, count = self.stored_range(message, MAX_BLOCKS)
+        if (count == 0):
+            return ([COUNT_STRUCT.pack(0)])
+        lengths, file_range = self.block_store.span(start, count)
+        return ([COUNT_STRUCT.pack(count),
+                 b''.join(LENGTH_STRUCT.pack(length) for length in lengths),
+                 file_range])
+
+    def process_get_tx_proof(self, message):
+        """Inclusion proof for a transaction in the block at a height."""
+        height = int.from_bytes(message[0:32], 'big')
+        location = self.tx_index.lookup(bytes(message[32:64]))
+        if location is None or location[0] != height:
+            return ([LENGTH_STRUCT.pack(0)])
+        index = location[1]
+        block_data = self.block_store.read(height)[HEADER_SIZE:]
+        leaves = [transaction_id(block_data[i:i + TX_SIZE])
+                  for i in range(0, len(block_data), TX_SIZE)]
+        proof_bytes = encode_proof(index, merkle_proof(leaves, index))
+        return ([LENGTH_STRUCT.pack(len(proof_bytes)), proof_bytes])
+
+    def process_get_tx(self, txid):
+        """Locate a confirmed transaction as a list of reply parts."""
+        location = self.tx_index.lookup(bytes(txid))
+        if location is None:
+            return ([LENGTH_STRUCT.pack(0)])
+        height, position = location
+        block_range = self.block_store.file_range(height)
+        tx_range = FileRange(block_range.file, block_range.offset
+                             + HEADER_SIZE + (position * TX_SIZE), TX_SIZE)
+        return ([LENGTH_STRUCT.pack(LENGTH_STRUCT.size + TX_SIZE),
+                 LENGTH_STRUCT.pack(height), tx_range])
@@ -0,0 +1,126 @@
+"""Fully validate blocks received from peers before accepting them.
+
+Tasks:
+    Check the block header links to our chain tip
+    Verify the proof of work against the difficulty
+    Decode and hash block transactions across a process pool
+    Check the transactions match the header Merkle root
+    Apply the transactions to the ledger in order, all or nothing
+"""
+
+import time
+import multiprocessing as mp
+
+from codec import TX_SIZE, TX_STRUCT, decode_digits
+from mempool import transaction_id
+from merkle import merkle_root
+from miner import MiningEngine
+
+MIN_CHUNK = 1024  # Fewest transactions worth sending to a worker
+
+
+def decode_chunk(chunk):
+    """Return (txid, sender, receiver, amount) for each transaction."""
+    decoded = []
+    for i, fields in enumerate(TX_STRUCT.iter_unpack(chunk)):
+        sender, receiver, amount, _ = fields
+        txid = transaction_id(chunk[i * TX_SIZE:(i + 1) * TX_SIZE])
+        decoded.append((txid, sender, receiver, decode_digits(amount)))
+    return (decoded)
+
+
+class BlockValidator(object):
+    """Run received blocks through header, PoW, decode and apply stages."""
+
+    def __init__(self, utxo, difficulty, numcores):
+        """Initialize validator for the ledger held by utxo."""
+        self.utxo = utxo
+        self.difficulty = difficulty
+        self.numcores = numcores
+        self.pool = None  # Decoding workers, started on first use
+        self.timings = {}  # Seconds spent in each stage of the last block
+
+    def decode_pool(self):
+        """Start the decoding workers on first use."""
+        if (self.numcores < 2):
+            return (None)
+        if self.pool is None:
+            self.pool = mp.Pool(self.numcores)
+        return (self.pool)
+
+    def check_header(self, block):
+        """Check the block extends our chain tip."""
+        return (len(block.block_data) % TX_SIZE == 0
+                and block.block_height == len(self.utxo.block_store)
+                and block.prior_hash == self.utxo.tip_hash())
+
+    def check_proof_of_work(self, block):
+        """Check the block hash is correct and meets the difficulty."""
+        engine = MiningEngine(block.hash_prefix(), self.difficulty)
+        digest = engine.hash_nonce(block.nonce)
+        return (digest == block.hash and digest <= engine.target)
+
+    def check_merkle_root(self, block, transactions):
+        """Check the decoded transactions hash to the header root."""
+        return (merkle_root([txid for txid, _, _, _ in transactions])
+                == block.merkle_root)
+
+    def decode_transactions(self, block_data):
+        """Decode and hash every transaction, in block order."""
+        pool = self.decode_pool()
+        count = len(block_data) // TX_SIZE
+        if pool is None or (count < MIN_CHUNK * 2):
+            return (decode_chunk(block_data))
+        per_chunk = max(MIN_CHUNK, -(-count // self.numcores))
+        chunks = [bytes(block_data[i * TX_SIZE:(i + per_chunk) * TX_SIZE])
+                  for i in range(0, count, per_chunk)]
+        decoded = []
+        for chunk_result in pool.map(decode_chunk, chunks):
+            decoded.extend(chunk_result)
+        return (decoded)
+
+    def stage(self, name, function, *args):
+        """Run one stage and record how long it took."""
+        start_time = time.perf_counter()
+        result = function(*args)
+        self.timings[name] = time.perf_counter() - start_time
+        return (result)
+
+    def validate_block(self, block):
+        """Validate and apply a block, return whether it was accepted."""
+        self.timings = {}
+        if not self.stage("header", self.check_header, block):
+            print("Block rejected: does not extend chain tip")
+            return (False)
+        if not self.stage("pow", self.check_proof_of_work, block):
+            print("Block rejected: invalid proof of work")
+            return (False)
+        try:
+            transactions = self.stage("decode", self.decode_transactions,
+                                      block.block_data)
+        except ValueError:
+            print("Block rejected: amount is not a number")
+            return (False)
+        if not self.stage("merkle", self.check_merkle_root, block,
+                          transactions):
+            print("Block rejected: transactions do not match Merkle root")
+            return (False)
+        if not self.stage("apply", self.utxo.apply_block_transactions,
+                          transactions):
+            print("Block rejected: invalid transaction")
+            return (False)
+        self.stage("store", self.utxo.process_block, block)
+        print("Block accepted. Stage timings: ", self.format_timings())
+        return (True)
+
+    def format_timings(self):
+        """Stage timings of the last block in milliseconds."""
+        return (" ".join("{}={:.2f}ms".format(name, seconds * 1000)
+                         for name, seconds in self.timings.items()))
+
+    def close(self):
+        """Shut down the decoding workers."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,205 @@
+"""Round trip every wire layout through its encoder and decoder.
+
+Tasks:
+    Check transactions, headers and batches decode to what was encoded
+    Check compact blocks and block transaction messages round trip
+    Check frames round trip and that bad lengths are refused
+"""
+
+import os
+import socket
+import struct
+
+import pytest
+
+from codec import (COUNT_STRUCT, FRAME_STRUCT, FRAME_VERSION, HEADER_SIZE,
+                   SHORT_ID_SIZE, TX_SIZE, check_digits,
+                   decode_block_txs, decode_block_txs_request,
+                   decode_compact_block, decode_frame_header, decode_header,
+                   decode_transaction, encode_batch, encode_block_txs,
+                   encode_block_txs_request, encode_compact_block,
+                   encode_frame, encode_header, encode_transaction,
+                   iter_transactions, short_id)
+from mempool import transaction_id
+from server import Server
+
+
+def make_transactions(count):
+    """Distinct transactions between random accounts."""
+    return ([encode_transaction(os.urandom(32), os.urandom(32), i + 1, i)
+             for i in range(count)])
+
+
+def make_header(block_height=12):
+    """Block header with random hashes."""
+    return (encode_header(7, os.urandom(32), os.urandom(32), block_height,
+                          99, os.urandom(32)))
+
+
+def test_transaction_round_trip():
+    """Transactions decode to the fields they were built from."""
+    sender, receiver = os.urandom(32), os.urandom(32)
+    tx_bytes = encode_transaction(sender, receiver, 12345, 678)
+    assert len(tx_bytes) == TX_SIZE
+    assert decode_transaction(tx_bytes) == (sender, receiver, 12345, 678)
+    assert decode_transaction(memoryview(b'x' + tx_bytes), 1) == (
+        sender, receiver, 12345, 678)
+
+
+def test_transaction_amount_digits_only():
+    """Signed or padded amounts are not numbers on the wire."""
+    sender, receiver = os.urandom(32), os.urandom(32)
+    negative = encode_transaction(sender, receiver, -500000, 0)
+    padded = negative.replace(b'-', b' ')
+    for tx_bytes in (negative, padded):
+        with pytest.raises(ValueError):
+            decode_transaction(tx_bytes)
+        with pytest.raises(ValueError):
+            list(iter_transactions(tx_bytes))
+        with pytest.raises(ValueError):
+            check_digits(make_transactions(2)[0] + tx_bytes)
+    check_digits(b''.join(make_transactions(2)))
+
+
+def test_transaction_too_short():
+    """A truncated transaction is refused."""
+    with pytest.raises(struct.error):
+        decode_transaction(encode_transaction(bytes(32), bytes(32), 1, 1)[1:])
+
+
+def test_header_round_trip():
+    """Headers decode to the fields they were built from."""
+    fields = (7, os.urandom(32), os.urandom(32), 2**40, 99, os.urandom(32))
+    header = encode_header(*fields)
+    assert len(header) == HEADER_SIZE
+    assert decode_header(header) == fields
+
+
+def test_header_too_short():
+    """A truncated header is refused."""
+    with pytest.raises(struct.error):
+        decode_header(make_header()[0:HEADER_SIZE - 1])
+
+
+def test_batch_round_trip():
+    """A batch holds its count and then its transactions."""
+    transactions = make_transactions(5)
+    batch = encode_batch(transactions)
+    assert COUNT_STRUCT.unpack_from(batch)[0] == 5
+    assert (list(iter_transactions(memoryview(batch)[COUNT_STRUCT.size:]))
+            == [decode_transaction(tx_bytes) for tx_bytes in transactions])
+
+
+def test_empty_batch():
+    """An empty batch is only its count."""
+    assert encode_batch([]) == COUNT_STRUCT.pack(0)
+
+
+def test_compact_block_round_trip():
+    """Compact blocks decode to the header and short ids."""
+    header = make_header()
+    txids = [transaction_id(tx_bytes) for tx_bytes in make_transactions(4)]
+    message = encode_compact_block(header, txids)
+    assert len(message) == HEADER_SIZE + COUNT_STRUCT.size + 4*SHORT_ID_SIZE
+    assert decode_compact_block(message) == (
+        header, [short_id(txid) for txid in txids])
+
+
+@pytest.mark.parametrize("trim, extra", [(1, b''), (0, b'x')])
+def test_compact_block_bad_length(trim, extra):
+    """Compact blocks must hold exactly their short ids."""
+    txids = [transaction_id(tx_bytes) for tx_bytes in make_transactions(3)]
+    message = encode_compact_block(make_header(), txids)
+    with pytest.raises(ValueError):
+        decode_compact_block(message[0:len(message) - trim] + extra)
+
+
+def test_block_txs_request_round_trip():
+    """Requests decode to the height, hash and positions."""
+    block_hash = os.urandom(32)
+    message = encode_block_txs_request(9, block_hash, [0, 5, 70000])
+    assert decode_block_txs_request(message) == (9, block_hash,
+                                                 [0, 5, 70000])
+
+
+def test_block_txs_request_bad_length():
+    """Requests must hold exactly their positions."""
+    message = encode_block_txs_request(9, os.urandom(32), [1, 2])
+    with pytest.raises(ValueError):
+        decode_block_txs_request(message[:-1])
+
+
+def test_block_txs_round_trip():
+    """Replies decode to the hash and transactions."""
+    block_hash = os.urandom(32)
+    transactions = make_transactions(3)
+    assert decode_block_txs(encode_block_txs(block_hash, transactions)) == (
+        block_hash, transactions)
+    assert decode_block_txs(encode_block_txs(block_hash, [])) == (
+        block_hash, [])
+
+
+def test_block_txs_bad_length():
+    """Replies must hold exactly their transactions."""
+    message = encode_block_txs(os.urandom(32), make_transactions(2))
+    with pytest.raises(ValueError):
+        decode_block_txs(message[:-TX_SIZE // 2])
+
+
+def test_frame_round_trip():
+    """Frames carry the version, opcode, length and message."""
+    message = os.urandom(300)
+    frame = encode_frame("4", message)
+    assert frame[0] == FRAME_VERSION
+    assert decode_frame_header(frame[1:FRAME_STRUCT.size]) == ("4", 300)
+    assert frame[FRAME_STRUCT.size:] == message
+    assert decode_frame_header(encode_frame("1")[1:]) == ("1", 0)
+
+
+def test_frame_header_too_short():
+    """A truncated frame header is refused."""
+    with pytest.raises(struct.error):
+        decode_frame_header(encode_frame("4", b'abc')[1:FRAME_STRUCT.size - 1])
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Node without a socket, to check frames against its message sizes."""
+    return (Server(["--port", "0", "--peers", "", "--numtxinblock", "10",
+                    "--datadir", str(tmp_path)], listen=False))
+
+
+def test_frame_sizes_checked(server):
+    """Framed messages must have the size their opcode calls for."""
+    batch = encode_batch(make_transactions(3))
+    assert server.check_frame("4", batch)
+    assert not server.check_frame("4", batch[:-1])
+    assert not server.check_frame("4", batch + b'x')
+    assert not server.check_frame("4", b'')
+    block = make_header(0) + b''.join(make_transactions(2))
+    assert server.check_frame("2", block)
+    assert not server.check_frame("2", block[:-1])
+    assert server.check_frame("1", b'')
+    assert not server.check_frame("1", b'x')
+
+
+def test_frame_header_refused(server):
+    """Unknown opcodes and oversized frames are refused."""
+    assert server.frame_allowed("4", 100)
+    assert not server.frame_allowed("Z", 100)
+    limit = server.max_message_size
+    assert server.frame_allowed("4", limit)
+    assert not server.frame_allowed("4", limit + 1)
+
+
+def test_oversized_messages_refused(server):
+    """Framed and unframed batches past the limit are not read."""
+    count = (server.max_message_size // TX_SIZE) + 1
+    batch = encode_batch(make_transactions(count))
+    for message in (encode_frame("4", batch), b'4' + batch):
+        node_end, client_end = socket.socketpair()
+        node_end.settimeout(5)  # Fail rather than wait for the rest
+        client_end.sendall(message[0:64])  # Refused from the header alone
+        assert server.process_data_bytes(node_end) is None
+        node_end.close()
+        client_end.close()
@@ -0,0 +1,77 @@
+"""Check Merkle roots and the inclusion proofs built from them.
+
+Tasks:
+    Match the incremental root against the root built level by level
+    Verify a proof for every leaf, before and after serialization
+    Refuse an inner node passed off as a transaction id
+    Answer GET_TX_PROOF from the transaction index
+"""
+
+from hashlib import sha256
+
+import pytest
+
+from codec import LENGTH_STRUCT, decode_header
+from mempool import transaction_id
+from merkle import (EMPTY_ROOT, RIGHT, IncrementalMerkleTree, decode_proof,
+                    encode_proof, merkle_levels, merkle_proof, merkle_root,
+                    verify_proof)
+from utxo import UTXO
+from benchmarks.workload import make_transactions
+
+
+def make_leaves(count):
+    """Distinct transaction ids."""
+    return ([sha256(bytes(str(i), 'ascii')).digest() for i in range(count)])
+
+
+def test_incremental_root_matches_levels():
+    """Appending leaves one by one gives the root of the full tree."""
+    leaves = make_leaves(17)
+    tree = IncrementalMerkleTree()
+    assert tree.root() == merkle_root([]) == EMPTY_ROOT
+    for count, leaf in enumerate(leaves, 1):
+        tree.append(leaf)
+        root, = merkle_levels(leaves[0:count])[-1]
+        assert tree.root() == merkle_root(leaves[0:count]) == root
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 8, 13])
+def test_proofs_verify(count):
+    """Every leaf has a proof to the root that survives encoding."""
+    leaves = make_leaves(count)
+    root = merkle_root(leaves)
+    for index, leaf in enumerate(leaves):
+        proof = merkle_proof(leaves, index)
+        assert verify_proof(leaf, proof, root)
+        assert decode_proof(encode_proof(index, proof)) == (index, proof)
+        assert not verify_proof(EMPTY_ROOT, proof, root)
+
+
+def test_inner_node_is_not_a_leaf():
+    """An inner node and its sibling do not prove a transaction."""
+    leaves = make_leaves(4)
+    left, right = merkle_levels(leaves)[1]
+    assert not verify_proof(left, [(RIGHT, right)], merkle_root(leaves))
+
+
+def test_get_tx_proof(tmp_path):
+    """A proof is served for the height the transaction is stored at."""
+    utxo = UTXO(10, 0, 0, datadir=str(tmp_path))
+    transactions = make_transactions(10)
+    utxo.process_batch(memoryview(b''.join(transactions)))
+    root = decode_header(utxo.block_store.read(0))[5]
+    txid = transaction_id(transactions[3])
+
+    length, proof_bytes = utxo.process_get_tx_proof(
+        (0).to_bytes(32, 'big') + txid)
+    assert LENGTH_STRUCT.unpack(length)[0] == len(proof_bytes)
+    index, proof = decode_proof(proof_bytes)
+    assert index == 3
+    assert verify_proof(txid, proof, root)
+
+    # Wrong height or unknown transaction
+    assert utxo.process_get_tx_proof((1).to_bytes(32, 'big') + txid) == [
+        LENGTH_STRUCT.pack(0)]
+    assert utxo.process_get_tx_proof((0).to_bytes(32, 'big') + bytes(32)) == [
+        LENGTH_STRUCT.pack(0)]
@@ -0,0 +1,65 @@
+"""Check mining jobs stop when, and only when, they are cancelled.
+
+Tasks:
+    Cancel a job before it reaches the workers
+    Cancel a job while the workers run it
+"""
+
+import os
+import time
+import threading
+
+import pytest
+
+from miner import MiningPool
+from benchmarks.workload import UNREACHABLE_DIFFICULTY
+
+
+@pytest.fixture
+def pool():
+    """Mining pool with a single worker."""
+    mining_pool = MiningPool(1)
+    yield mining_pool
+    mining_pool.close()
+
+
+def run_job(mining_pool, difficulty, cancelled):
+    """Mine on a thread, return the thread and a list to hold its result."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(mining_pool.mine(
+        os.urandom(64), difficulty, 0, cancelled)), daemon=True)
+    thread.start()
+    return (thread, result)
+
+
+def wait_active(mining_pool, cancelled):
+    """Wait until the workers run the job of cancelled."""
+    deadline = time.time() + 5
+    while (mining_pool.active is not cancelled):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_cancel_before_start(pool):
+    """A job cancelled while it waits for the workers is never mined."""
+    running = threading.Event()
+    first, _ = run_job(pool, UNREACHABLE_DIFFICULTY, running)
+    wait_active(pool, running)
+    waiting = threading.Event()
+    second, result = run_job(pool, 1, waiting)  # Easy, if it ever ran
+    pool.cancel(waiting)
+    pool.cancel(running)
+    first.join(5)
+    second.join(5)
+    assert result == [None]
+
+
+def test_cancel_while_running(pool):
+    """A running job stops and later jobs still mine."""
+    running = threading.Event()
+    thread, result = run_job(pool, UNREACHABLE_DIFFICULTY, running)
+    wait_active(pool, running)
+    pool.cancel(running)
+    thread.join(5)
+    assert result == [None]
+    assert pool.mine(os.urandom(64), 1, 0, threading.Event()) is not None
@@ -0,0 +1,41 @@
+"""Check what peer connections send when the network fails.
+
+Tasks:
+    Queue messages again whole after a partial write, never their tail
+"""
+
+import pytest
+
+from peers import PeerConnection
+
+
+class BreakingSocket(object):
+    """Takes limit bytes, then fails like a dropped connection."""
+
+    def __init__(self, limit):
+        """Initialize socket accepting limit more bytes."""
+        self.limit = limit
+        self.data = bytearray()
+
+    def sendmsg(self, buffers):
+        """Write what fits under the limit, fail once it is reached."""
+        if not self.limit:
+            raise ConnectionResetError("Connection dropped")
+        chunk = b''.join(bytes(buffer) for buffer in buffers)[0:self.limit]
+        self.data.extend(chunk)
+        self.limit -= len(chunk)
+        return (len(chunk))
+
+
+def test_partial_message_requeued_whole():
+    """A message cut off by a dropped connection is resent from its start."""
+    connection = PeerConnection(0)
+    connection.close()  # Drive send_batch without the sender thread
+    messages = [b'a' * 10, b'b' * 10, b'c' * 10]
+    connection.queued_bytes = 30
+    connection.socket = BreakingSocket(15)
+    with pytest.raises(OSError):
+        connection.send_batch(messages)
+    assert list(connection.queue) == messages[1:]
+    assert connection.queued_bytes == 20
+    assert connection.socket.data == b'a' * 10 + b'b' * 5
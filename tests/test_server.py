@@ -0,0 +1,234 @@
+"""Check how nodes pass blocks between each other.
+
+Tasks:
+    Relay blocks a node accepts, not only blocks it mines
+    Fetch a compact block in full when a short id matched the wrong tx
+    Serve peers and clients together in process mode
+    Drop a client that sends a malformed message, not the node
+    Keep mining our block until a competing block proves valid
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+
+import compact as compact_module
+from codec import (FRAME_STRUCT, LENGTH_STRUCT, decode_block_txs_request,
+                   decode_frame_header, encode_batch, encode_frame, short_id)
+from mempool import transaction_id
+from server import (BLOCK_OPCODE, BLOCK_TXS_OPCODE, CLOSE_OPCODE, COMPACT_BLOCK_OPCODE,
+                    GET_BLOCK_OPCODE, GET_BLOCK_TXS_OPCODE, TX_BATCH_OPCODE,
+                    Server)
+from benchmarks.network import connect, receive_exactly
+from benchmarks.workload import account, make_transactions
+
+# Transaction whose amount is not a number
+BAD_TX = account(0) + account(1) + b'x' * 32 + b'0' * 32
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src")
+
+
+class RecordingPeers(object):
+    """Stands in for a PeerManager, keeping what the node broadcasts."""
+
+    def __init__(self):
+        """Initialize with nothing sent."""
+        self.connections = []
+        self.frames = []
+
+    def broadcast(self, message):
+        """Keep the frame as (opcode, message)."""
+        opcode, length = decode_frame_header(message[1:FRAME_STRUCT.size])
+        self.frames.append((opcode, bytes(message[FRAME_STRUCT.size:])))
+
+    def close(self):
+        """Nothing to flush."""
+
+    def sent(self, opcode):
+        """Messages broadcast with opcode."""
+        return ([message for sent, message in self.frames if sent == opcode])
+
+
+class RecordingMiner(object):
+    """Stands in for a BackgroundMiner, counting starts and cancels."""
+
+    def __init__(self):
+        """Initialize with no jobs."""
+        self.started = 0
+        self.cancelled = 0
+
+    def start(self, block):
+        """Count a started job."""
+        self.started += 1
+
+    def cancel(self):
+        """Count a cancelled job."""
+        self.cancelled += 1
+
+
+def make_node(tmp_path, name):
+    """Node without a socket whose broadcasts are recorded."""
+    node = Server(["--port", "0", "--peers", "", "--numtxinblock", "10",
+                   "--datadir", str(tmp_path / name)], listen=False,
+                  peer_manager=RecordingPeers())
+    return (node)
+
+
+def test_accepted_block_relayed(tmp_path):
+    """A block rebuilt from a compact block is relayed on to peers."""
+    miner, node = make_node(tmp_path, "miner"), make_node(tmp_path, "node")
+    miner.process_message(TX_BATCH_OPCODE,
+                          encode_batch(make_transactions(10)))
+    compact, = miner.peer_manager.sent(COMPACT_BLOCK_OPCODE)
+
+    # Node has none of the transactions and asks the miner for them
+    request, = node.process_message(COMPACT_BLOCK_OPCODE, compact)
+    opcode, length = decode_frame_header(request[1:FRAME_STRUCT.size])
+    assert opcode == GET_BLOCK_TXS_OPCODE
+    reply = miner.answer_request(opcode, request[FRAME_STRUCT.size:])
+    node.process_message(BLOCK_TXS_OPCODE, reply[FRAME_STRUCT.size:])
+
+    assert len(node.utxo.block_store) == 1
+    assert node.peer_manager.sent(COMPACT_BLOCK_OPCODE) == [compact]
+
+
+def test_short_id_collision_refetched(tmp_path, monkeypatch):
+    """A block rebuilt with the wrong pending tx is fetched again whole."""
+    miner, node = make_node(tmp_path, "miner"), make_node(tmp_path, "node")
+    transactions = make_transactions(10)
+    miner.process_message(TX_BATCH_OPCODE, encode_batch(transactions))
+    compact, = miner.peer_manager.sent(COMPACT_BLOCK_OPCODE)
+    # Pending transaction whose short id matches the first one of the block
+    colliding = make_transactions(1, 100)[0]
+    block_txid, colliding_txid = map(transaction_id, (transactions[0],
+                                                      colliding))
+    monkeypatch.setattr(compact_module, "short_id", lambda txid: short_id(
+        block_txid if txid == colliding_txid else txid))
+    node.utxo.mempool.add(colliding_txid, colliding)
+
+    request, = node.process_message(COMPACT_BLOCK_OPCODE, compact)
+    assert decode_block_txs_request(request[FRAME_STRUCT.size:])[2] == list(
+        range(1, 10))
+    reply = miner.answer_request(GET_BLOCK_TXS_OPCODE,
+                                 request[FRAME_STRUCT.size:])
+    request, = node.process_message(BLOCK_TXS_OPCODE,
+                                    reply[FRAME_STRUCT.size:])
+    assert decode_block_txs_request(request[FRAME_STRUCT.size:])[2] == list(
+        range(10))
+    assert len(node.utxo.block_store) == 0
+    reply = miner.answer_request(GET_BLOCK_TXS_OPCODE,
+                                 request[FRAME_STRUCT.size:])
+    node.process_message(BLOCK_TXS_OPCODE, reply[FRAME_STRUCT.size:])
+    assert len(node.utxo.block_store) == 1
+
+
+def free_port():
+    """Port nothing is listening on."""
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return (probe.getsockname()[1])
+
+
+def block_length(port, height):
+    """Length of the block a node stores at height, 0 if it has none."""
+    with connect(port) as node_socket:
+        node_socket.settimeout(5)
+        node_socket.sendall(encode_frame(GET_BLOCK_OPCODE,
+                                         height.to_bytes(32, 'big')))
+        return (LENGTH_STRUCT.unpack(
+            receive_exactly(node_socket, LENGTH_STRUCT.size))[0])
+
+
+def test_process_mode_peers(tmp_path):
+    """Two peered process mode nodes keep serving clients and each other."""
+    ports = [free_port(), free_port()]
+    nodes = []
+    for port, peer in zip(ports, reversed(ports)):
+        command = [sys.executable, "main.py", "--port", str(port),
+                   "--peers", str(peer), "--numtxinblock", "10",
+                   "--maxblockwait", "0",
+                   "--datadir", str(tmp_path / str(port))]
+        nodes.append(subprocess.Popen(command, cwd=SRC_DIR,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.STDOUT))
+    try:
+        with connect(ports[0]) as node_socket:
+            node_socket.settimeout(5)
+            node_socket.sendall(encode_frame(
+                TX_BATCH_OPCODE, encode_batch(make_transactions(10))))
+            receive_exactly(node_socket, 2)
+        # The block is relayed over the peer connection the nodes share
+        deadline = time.time() + 10
+        while (block_length(ports[1], 0) == 0):
+            assert time.time() < deadline
+            time.sleep(0.1)
+        with connect(ports[0]) as node_socket:
+            node_socket.sendall(encode_frame(CLOSE_OPCODE))
+        for node in nodes:
+            node.wait(10)
+    finally:
+        for node in nodes:
+            node.kill()
+
+
+def tcp_pair():
+    """Return (node end, client end) of a local TCP connection."""
+    with socket.socket() as listener:
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        client_end = socket.create_connection(listener.getsockname())
+        node_end, _ = listener.accept()
+    client_end.settimeout(5)
+    return (node_end, client_end)
+
+
+def test_bad_message_closes_client(tmp_path):
+    """A process mode client sending a malformed message is dropped."""
+    node = make_node(tmp_path, "node")
+    node_end, client_end = tcp_pair()
+    client_end.sendall(b'0' + BAD_TX)
+    node.connect_socket(node_end, node_end.getpeername())
+    assert client_end.recv(1) == b''
+    client_end.close()
+
+
+def test_bad_message_closes_asyncio_client(tmp_path):
+    """An asyncio client sending a malformed message is dropped."""
+    node = make_node(tmp_path, "node")
+    node_end, client_end = tcp_pair()
+    client_end.sendall(encode_frame(TX_BATCH_OPCODE, encode_batch([BAD_TX])))
+
+    async def serve():
+        reader, writer = await asyncio.open_connection(sock=node_end)
+        await node.handle_client(reader, writer)
+        await writer.wait_closed()
+
+    asyncio.run(serve())
+    assert client_end.recv(1) == b''
+    client_end.close()
+
+
+def test_invalid_block_keeps_mining(tmp_path):
+    """A block with valid work but bad transactions does not stop ours."""
+    miner, node = make_node(tmp_path, "miner"), make_node(tmp_path, "node")
+    miner.process_message(TX_BATCH_OPCODE,
+                          encode_batch(make_transactions(10, 100)))
+    block = bytes(miner.utxo.block_store.read(0))
+    node.utxo.background_miner = RecordingMiner()
+    node.process_message(TX_BATCH_OPCODE, encode_batch(make_transactions(10)))
+    candidate = node.utxo.candidate
+    assert node.utxo.background_miner.started == 1
+
+    # Header and proof of work still hold, the Merkle root does not
+    tampered = block[0:-1] + bytes([block[-1] ^ 1])
+    node.process_message(BLOCK_OPCODE, tampered)
+    assert node.utxo.background_miner.cancelled == 0
+    assert node.utxo.candidate is candidate
+    assert node.utxo.background_miner.started == 1
+
+    node.process_message(BLOCK_OPCODE, block)
+    assert node.utxo.background_miner.cancelled == 1
+    assert len(node.utxo.block_store) == 1
@@ -0,0 +1,39 @@
+"""Check nodes driven by the network simulator settle under load.
+
+Tasks:
+    Relay every transaction at most once per node, even with full mempools
+"""
+
+import random
+
+from codec import COUNT_STRUCT, TX_SIZE
+from mempool import transaction_id
+from server import RELAY_BATCH_OPCODE
+from benchmarks.simulate import (Network, SimPeers, decode_frame,
+                                 parse_commandline, synthetic_workload)
+
+
+def test_no_transaction_relayed_twice(tmp_path, monkeypatch):
+    """Overloaded nodes never drop a transaction and take it back."""
+    relayed = {}  # Node to ids of the transactions it relayed
+    broadcast = SimPeers.broadcast
+
+    def check_relayed(peers, message):
+        opcode, batch = decode_frame(message)
+        if (opcode == RELAY_BATCH_OPCODE):
+            seen = relayed.setdefault(peers.node, set())
+            for start in range(COUNT_STRUCT.size, len(batch), TX_SIZE):
+                txid = transaction_id(batch[start:start + TX_SIZE])
+                assert txid not in seen, "relay loop"
+                seen.add(txid)
+        broadcast(peers, message)
+
+    monkeypatch.setattr(SimPeers, "broadcast", check_relayed)
+    # More transactions than blocks can confirm, so every mempool fills up
+    arg_list = parse_commandline(["--nodes", "30", "--numtxinblock", "20",
+                                  "--batch", "20", "--blocktime", "0.2",
+                                  "--latency", "100", "--duration", "10"])
+    network = Network(arg_list, str(tmp_path))
+    workload = synthetic_workload(arg_list, random.Random(arg_list.seed))
+    network.run(workload, arg_list.duration + arg_list.settle)
+    assert relayed
@@ -0,0 +1,69 @@
+"""Check the transaction index keeps its entries across growth and restarts.
+
+Tasks:
+    Find every transaction after the table has grown
+    Read the entry count back from the table header
+    Keep the old table whole when a grow stops part way
+"""
+
+import os
+from hashlib import sha256
+
+import pytest
+
+import txindex
+from txindex import TxIndex
+
+
+def make_txids(start, count):
+    """Distinct transaction ids."""
+    return ([sha256(bytes(str(i), 'ascii')).digest()
+             for i in range(start, start + count)])
+
+
+@pytest.fixture
+def small_tables(monkeypatch):
+    """Start tables small so a few entries make them grow."""
+    monkeypatch.setattr(txindex, "MIN_SLOTS", 8)
+
+
+def test_grow_keeps_entries(tmp_path, small_tables):
+    """Entries survive growth and are counted again after reopening."""
+    index = TxIndex(str(tmp_path))
+    txids = make_txids(0, 20)
+    for position, txid in enumerate(txids):
+        index.add(txid, 1, position)
+    assert index.num_slots == 64
+    index.save()
+    index.close()
+    assert not os.path.exists(index.path + ".tmp")
+
+    reopened = TxIndex(str(tmp_path))
+    assert reopened.count == 20
+    assert [reopened.lookup(txid) for txid in txids] == [
+        (1, position) for position in range(20)]
+    assert make_txids(20, 1)[0] not in reopened
+    reopened.close()
+
+
+def test_stopped_grow_keeps_table(tmp_path, small_tables, monkeypatch):
+    """A grow stopped while moving entries leaves the table as it was."""
+    index = TxIndex(str(tmp_path))
+    txids = make_txids(0, 4)
+    for position, txid in enumerate(txids):
+        index.add(txid, 0, position)
+
+    def stop(bloom, txid):
+        raise RuntimeError("Stopped while moving entries")
+
+    monkeypatch.setattr(txindex.BloomFilter, "add", stop)
+    with pytest.raises(RuntimeError):
+        index.add(make_txids(4, 1)[0], 0, 4)
+    index.close()
+    monkeypatch.undo()
+
+    reopened = TxIndex(str(tmp_path))
+    assert reopened.count == 4
+    assert [reopened.lookup(txid) for txid in txids] == [
+        (0, position) for position in range(4)]
+    reopened.close()
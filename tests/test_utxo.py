@@ -0,0 +1,152 @@
+"""Check the ledger kept by UTXO stays consistent with its blocks.
+
+Tasks:
+    Rebuild balances from stored blocks when the snapshot falls behind
+    Snapshot the ledger every few blocks rather than after each one
+    Refuse to start from a snapshot ahead of the block store
+    Accept the same transactions whatever the number of ledger shards
+    Refuse amounts that are not positive wherever they reach the ledger
+"""
+
+import os
+import random
+import shutil
+
+import pytest
+
+import utxo as utxo_module
+from codec import encode_transaction
+from ledger import Ledger
+from transaction import Transaction
+from utxo import UTXO
+from validator import decode_chunk
+from benchmarks.workload import NUM_ACCOUNTS, account, make_transactions
+
+
+def balances(utxo):
+    """Balance of every default account."""
+    return ([utxo.utxo[account(i)] for i in range(NUM_ACCOUNTS)])
+
+
+def process(utxo, transactions):
+    """Run transactions through the node as one batch."""
+    return (utxo.process_batch(memoryview(b''.join(transactions))))
+
+
+def test_replays_blocks_past_snapshot(tmp_path):
+    """Blocks stored after the snapshot are applied again on restart."""
+    datadir = str(tmp_path)
+    utxo = UTXO(10, 0, 0, datadir=datadir)
+    process(utxo, make_transactions(10))
+    utxo.flush()
+    stale = str(tmp_path / "stale.snap")
+    shutil.copy(utxo.snapshot_path(), stale)
+    process(utxo, make_transactions(20, 10))
+    expected = balances(utxo)
+    assert len(utxo.block_store) == 3
+    utxo.block_store.close()
+    # Node stopped after storing blocks but before saving the snapshot
+    shutil.copy(stale, utxo.snapshot_path())
+    os.remove(os.path.join(datadir, "txindex.tbl"))
+    os.remove(os.path.join(datadir, "txindex.bloom"))
+
+    restarted = UTXO(10, 0, 0, datadir=datadir)
+    assert balances(restarted) == expected
+    flags, _, _ = process(restarted, make_transactions(1, 25))
+    assert flags == [False]  # Replayed transactions are confirmed again
+
+
+def test_snapshot_every_interval(tmp_path, monkeypatch):
+    """Blocks are snapshotted every SNAPSHOT_INTERVAL, not one by one."""
+    monkeypatch.setattr(utxo_module, "SNAPSHOT_INTERVAL", 2)
+    utxo = UTXO(10, 0, 0, datadir=str(tmp_path))
+    process(utxo, make_transactions(10))
+    assert not os.path.exists(utxo.snapshot_path())
+    process(utxo, make_transactions(20, 10))
+    assert Ledger().restore(utxo.snapshot_path()) == 2
+    utxo.flush()
+    assert Ledger().restore(utxo.snapshot_path()) == 3
+
+
+def test_refuses_snapshot_ahead_of_blocks(tmp_path):
+    """A snapshot newer than the stored blocks is not trusted."""
+    datadir = str(tmp_path)
+    utxo = UTXO(10, 0, 0, datadir=datadir)
+    process(utxo, make_transactions(10))
+    utxo.flush()
+    utxo.block_store.close()
+    os.remove(os.path.join(datadir, "blocks.idx"))
+    with pytest.raises(RuntimeError):
+        UTXO(10, 0, 0, datadir=datadir)
+
+
+def tricky_batches():
+    """Batches whose senders are paid or refunded earlier in the batch."""
+    missing = bytes(32)
+    yield ([encode_transaction(account(0), account(1), 99999, 0),
+            encode_transaction(account(1), account(2), 199998, 0)])
+    yield ([encode_transaction(account(3), missing, 99999, 0),
+            encode_transaction(account(3), account(4), 5, 0)])
+    rng = random.Random(7)
+    yield ([encode_transaction(account(rng.randrange(6)),
+                               account(rng.randrange(6)),
+                               rng.randrange(1, 150000), i)
+            for i in range(300)])
+
+
+@pytest.mark.parametrize("num_shards", [2, 4])
+def test_sharded_batches_match_unsharded(tmp_path, num_shards):
+    """Accept flags and balances do not depend on the number of shards."""
+    utxo = UTXO(1000, 0, 0, datadir=str(tmp_path / "1"))
+    sharded = UTXO(1000, 0, 0, datadir=str(tmp_path / "k"),
+                   num_shards=num_shards)
+    try:
+        for batch in tricky_batches():
+            flags, _, _ = process(utxo, batch)
+            assert process(sharded, batch)[0] == flags
+            assert balances(sharded) == balances(utxo)
+    finally:
+        sharded.utxo.close()
+
+
+@pytest.mark.parametrize("num_shards", [1, 2])
+def test_block_spends_its_own_credits(tmp_path, num_shards):
+    """A block may pay a sender before it spends, but not overspend."""
+    utxo = UTXO(1000, 0, 0, datadir=str(tmp_path), num_shards=num_shards)
+    try:
+        before = balances(utxo)
+        overspend = [encode_transaction(account(0), account(1), 99999, 0),
+                     encode_transaction(account(1), account(2), 199999, 0)]
+        assert not utxo.apply_block_transactions(
+            decode_chunk(b''.join(overspend)))
+        assert balances(utxo) == before
+        chained = [encode_transaction(account(0), account(1), 99999, 0),
+                   encode_transaction(account(1), account(2), 199998, 0)]
+        assert utxo.apply_block_transactions(decode_chunk(b''.join(chained)))
+        assert balances(utxo)[0:3] == [1, 1, 299998]
+    finally:
+        if (num_shards > 1):
+            utxo.utxo.close()
+
+
+@pytest.mark.parametrize("num_shards", [1, 2])
+def test_amounts_must_be_positive(tmp_path, num_shards):
+    """Zero amounts are refused, negative ones are not numbers at all."""
+    utxo = UTXO(1000, 0, 0, datadir=str(tmp_path), num_shards=num_shards)
+    try:
+        before = balances(utxo)
+        negative = encode_transaction(account(0), account(1), -500000, 0)
+        zero = encode_transaction(account(0), account(1), 0, 0)
+        with pytest.raises(ValueError):
+            process(utxo, [make_transactions(1)[0], negative])
+        with pytest.raises(ValueError):
+            Transaction(negative)
+        with pytest.raises(ValueError):
+            decode_chunk(negative)
+        assert process(utxo, [zero])[0] == [False]
+        assert utxo.process_transaction(Transaction(zero)) == (False, None)
+        assert not utxo.apply_block_transactions(decode_chunk(zero))
+        assert balances(utxo) == before
+    finally:
+        if (num_shards > 1):
+            utxo.utxo.close()